@@ -0,0 +1,271 @@
+"""
+Synthetic load benchmark for TwitchListen and on_presence_update.
+
+The Twitch client and the Discord guilds, channels, roles, members and messages are replaced
+by the fakes in fakes.py, so it runs offline, with no tokens, in a temporary working directory.
+
+Run:
+python bench/bench.py --guilds 5000 --streamers 50000 --out bench_results.json
+and compare against an earlier run with:
+python bench/bench.py --guilds 5000 --streamers 50000 --compare bench_results.json
+"""
+import argparse, asyncio, contextlib, json, os, platform, random, resource, shutil, subprocess, sys, tempfile, time, tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+SRC_DIR = os.path.join(REPO_DIR, "src")
+
+BOT_ID = 1
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark TwitchListen and on_presence_update against fake Twitch and Discord fleets.")
+    parser.add_argument("--guilds", type=int, default=100, help="number of guilds")
+    parser.add_argument("--streamers", type=int, default=2000, help="number of distinct Twitch logins the guilds pick from")
+    parser.add_argument("--per-guild", type=int, default=50, help="Twitch logins watched by each guild")
+    parser.add_argument("--categories", type=int, default=0, help="categories in each guild's filter, 0 for no filter")
+    parser.add_argument("--live", type=float, default=0.1, help="fraction of Twitch logins that are live")
+    parser.add_argument("--members", type=int, default=20, help="members with the streamer role in each guild")
+    parser.add_argument("--bystanders", type=int, default=0, help="members without the streamer role in each guild, whose presence updates are in the burst too")
+    parser.add_argument("--discord-live", type=float, default=0.1, help="fraction of those members streaming at the start")
+    parser.add_argument("--ticks", type=int, default=10, help="TwitchListen ticks to run")
+    parser.add_argument("--churn", type=float, default=0.05, help="fraction of live streams that change between ticks")
+    parser.add_argument("--presence", type=int, default=1000, help="presence updates in the burst after the ticks")
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds each fake Twitch request takes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--no-tracemalloc", action="store_true", help="don't trace allocations, which slows everything down")
+    parser.add_argument("--verbose", action="store_true", help="show what the bot prints")
+    parser.add_argument("--out", help="file to save the results to, as JSON")
+    parser.add_argument("--compare", help="results from an earlier run to compare against")
+    return parser.parse_args()
+
+def percentiles(samples: list[float]) -> dict:
+    """
+    Summarizes durations in seconds as milliseconds.
+    """
+    if not samples:
+        return {"count": 0}
+    s = sorted(samples)
+    def at(p: float) -> float:
+        return round(s[min(len(s) - 1, int(p * len(s)))] * 1000, 3)
+    return {
+        "count": len(s),
+        "mean_ms": round(sum(s) / len(s) * 1000, 3),
+        "p50_ms": at(0.5),
+        "p90_ms": at(0.9),
+        "p99_ms": at(0.99),
+        "max_ms": round(s[-1] * 1000, 3),
+    }
+
+def git_rev() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def counts_since(now: dict, before: dict) -> dict:
+    return {k: v - before.get(k, 0) for k, v in now.items()}
+
+async def run(args: argparse.Namespace) -> dict:
+    import discord
+    import fakes
+    import MatoStreamshow as M
+    import save
+    import writes
+
+    rng = random.Random(args.seed)
+    games = ["Game " + str(i) for i in range(50)]
+    logins = ["Streamer" + str(i) for i in range(args.streamers)]
+    live: dict[str, fakes.Stream] = {}
+    for login in logins:
+        if rng.random() < args.live:
+            live[login.casefold()] = fakes.Stream(login, "u" + login.casefold(), rng.choice(games), "title")
+
+    #region Fleet
+
+    bot = M.bot
+    bot._connection.user = fakes.Author(BOT_ID)
+    guilds: dict[int, fakes.Guild] = {}
+    channels: dict[int, fakes.Channel] = {}
+    members: list[fakes.Member] = []
+    next_id = 1000
+    for gi in range(args.guilds):
+        # Spread over the id bits that shards are picked by
+        gid = (gi << 22) | (1 << 40)
+        guild = fakes.Guild(gid)
+        guilds[gid] = guild
+        channel = fakes.Channel(guild, gid + 1, BOT_ID)
+        channels[channel.id] = channel
+        streamer_role = fakes.Role(guild, gid + 2)
+        live_role = fakes.Role(guild, gid + 3)
+        guild.roles[streamer_role.id] = streamer_role
+        guild.roles[live_role.id] = live_role
+        for mi in range(args.members):
+            next_id += 1
+            m = fakes.Member(guild, next_id, "Member" + str(next_id))
+            m.roles.append(streamer_role)
+            streamer_role.members.append(m)
+            guild.members[m.id] = m
+            members.append(m)
+            if rng.random() < args.discord_live:
+                m.activities = (fakes.streaming("DiscordStreamer" + str(m.id), rng.choice(games), "title"),)
+        for mi in range(args.bystanders):
+            next_id += 1
+            m = fakes.Member(guild, next_id, "Member" + str(next_id))
+            guild.members[m.id] = m
+            members.append(m)
+        g = str(gid)
+        save.init_guild_data(g)
+        d = save.get_guild_data(g)
+        d["name"] = guild.name
+        d["channel_id"] = channel.id
+        d["live_role_id"] = live_role.id
+        d["streamer_roles"] = {str(streamer_role.id): 0 < args.categories}
+        d["muted_role_list"] = []
+        d["twitch_streamer_list"] = sorted(rng.sample(logins, min(args.per_guild, len(logins))), key=str.casefold)
+        d["twitch_category_list"] = rng.sample(games, args.categories) if 0 < args.categories else []
+    save.rebuild_index()
+    bot.get_guild = guilds.get
+    bot.get_channel = channels.get
+    bot.get_partial_messageable = channels.get
+    bot.http = fakes.HTTP(guilds)
+    twitch = fakes.Twitch(live, args.latency)
+    M.api = twitch
+
+    #endregion Fleet
+
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    #region Ticks
+
+    tick_times: list[float] = []
+    drain_times: list[float] = []
+    for i in range(args.ticks):
+        if 0 < i:
+            # Some streams change title, some go offline, and as many others come online
+            for lower_name in rng.sample(list(live.keys()), int(len(live) * args.churn)):
+                if rng.random() < 0.5:
+                    live[lower_name].title = "title " + str(i)
+                else:
+                    live.pop(lower_name, None)
+                    login = rng.choice(logins)
+                    live[login.casefold()] = fakes.Stream(login, "u" + login.casefold(), rng.choice(games), "title")
+        t = time.perf_counter()
+        await bot.TwitchListen.coro(bot)
+        tick_times.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        await writes.scheduler.drain()
+        drain_times.append(time.perf_counter() - t)
+    tick_twitch_calls = dict(twitch.calls)
+    tick_discord_calls = dict(fakes.discord_calls)
+
+    #endregion Ticks
+
+    #region Presence burst
+
+    presence_times: list[float] = []
+    for _ in range(args.presence):
+        m = rng.choice(members)
+        if m.activities:
+            m.activities = ()
+        else:
+            m.activities = (fakes.streaming("DiscordStreamer" + str(m.id), rng.choice(games), "title"),)
+        t = time.perf_counter()
+        await bot.on_presence_update(m, m)
+        presence_times.append(time.perf_counter() - t)
+    # Updates from members who were already live wait out the coalescing window
+    await asyncio.gather(*M.presence_flushes.values())
+    t = time.perf_counter()
+    await writes.scheduler.drain()
+    presence_drain = time.perf_counter() - t
+
+    #endregion Presence burst
+
+    traced_peak = None
+    if not args.no_tracemalloc:
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return {
+        "params": vars(args),
+        "git_rev": git_rev(),
+        "python": platform.python_version(),
+        "discord_py": discord.__version__,
+        "watched_logins": len(save.get_lower_set_all()),
+        "live_logins": len(live),
+        "ticks": {
+            "first_ms": round(tick_times[0] * 1000, 3) if tick_times else None,
+            "all": percentiles(tick_times),
+            "after_first": percentiles(tick_times[1:]),
+            "write_drain": percentiles(drain_times),
+        },
+        "presence": {
+            "handler": percentiles(presence_times),
+            "write_drain_ms": round(presence_drain * 1000, 3),
+        },
+        "api_calls": {
+            "ticks": {"twitch": tick_twitch_calls, "discord": tick_discord_calls},
+            "presence": {"twitch": counts_since(twitch.calls, tick_twitch_calls), "discord": counts_since(fakes.discord_calls, tick_discord_calls)},
+        },
+        "memory": {
+            "tracemalloc_peak_bytes": traced_peak,
+            # Linux reports this in kilobytes
+            "max_rss_bytes": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        },
+        "messages_posted": sum((len(c.messages) for c in channels.values())),
+    }
+
+def compare(old: dict, new: dict):
+    rows = [
+        ("first tick ms", ["ticks", "first_ms"]),
+        ("tick p50 ms", ["ticks", "after_first", "p50_ms"]),
+        ("tick p99 ms", ["ticks", "after_first", "p99_ms"]),
+        ("presence p50 ms", ["presence", "handler", "p50_ms"]),
+        ("presence p99 ms", ["presence", "handler", "p99_ms"]),
+        ("get_streams calls", ["api_calls", "ticks", "twitch", "get_streams"]),
+        ("discord sends", ["api_calls", "ticks", "discord", "send"]),
+        ("discord edits", ["api_calls", "ticks", "discord", "edit"]),
+        ("tracemalloc peak", ["memory", "tracemalloc_peak_bytes"]),
+    ]
+    print("Compared to " + str(old.get("git_rev")) + ":")
+    for label, path in rows:
+        a: object = old
+        b: object = new
+        for k in path:
+            a = a.get(k) if isinstance(a, dict) else None
+            b = b.get(k) if isinstance(b, dict) else None
+        if isinstance(a, (int, float)) and isinstance(b, (int, float)) and a:
+            print("  " + label + ": " + str(a) + " -> " + str(b) + " (" + format(b / a, ".2f") + "x)")
+        else:
+            print("  " + label + ": " + str(a) + " -> " + str(b))
+
+def main():
+    args = parse_args()
+    out = args.out and os.path.abspath(args.out)
+    old = None
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+    # The bot reads config.json and writes save.json and image_cache.db in its working directory
+    workdir = tempfile.mkdtemp(prefix="matostreamshow-bench-")
+    with open(os.path.join(workdir, "config.json"), "w") as f:
+        # A Twitch rate limit budget high enough that the ticks measure the bot, not helix.limiter waiting
+        json.dump({"token": "bench", "twitch_api_id": "bench", "twitch_api_secret": "bench", "save_interval": 3600, "twitch_points_per_minute": 10 ** 9}, f)
+    os.chdir(workdir)
+    sys.path.insert(0, SRC_DIR)
+    sys.path.insert(0, BENCH_DIR)
+    try:
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else open(os.devnull, "w")):
+            results = asyncio.run(run(args))
+    finally:
+        os.chdir(REPO_DIR)
+        shutil.rmtree(workdir, ignore_errors=True)
+    print(json.dumps(results, indent=4))
+    if out:
+        with open(out, "w") as f:
+            json.dump(results, f, indent=4)
+    if old:
+        compare(old, results)
+
+if __name__ == "__main__":
+    main()
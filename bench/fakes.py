@@ -0,0 +1,230 @@
+"""
+In-process stand-ins for the Twitch API client and the discord.py objects the bot touches,
+which count every call made to them instead of going over the network.
+"""
+import asyncio, datetime, itertools
+
+import discord
+
+# ---------------------------------------------------------
+
+# Twitch
+
+class Stream:
+    def __init__(self, user_name: str, user_id: str, game_name: str, title: str):
+        self.user_name = user_name
+        self.user_login = user_name.casefold()
+        self.user_id = user_id
+        self.game_name = game_name
+        self.game_id = "g" + game_name
+        self.title = title
+        self.thumbnail_url = "https://static-cdn.jtvnw.net/previews-ttv/live_user_" + self.user_login + "-{width}x{height}.jpg"
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+
+class User:
+    def __init__(self, login: str, user_id: str):
+        self.login = login.casefold()
+        # Twitch has the display name, the bot only asks by casefolded login
+        self.display_name = login[:1].upper() + login[1:]
+        self.id = user_id
+        self.profile_image_url = "https://static-cdn.jtvnw.net/jtv_user_pictures/" + self.login + "-profile_image-300x300.png"
+
+class Game:
+    def __init__(self, name: str):
+        self.name = name
+        self.id = "g" + name
+        self.box_art_url = "https://static-cdn.jtvnw.net/ttv-boxart/" + name + "-{width}x{height}.jpg"
+
+class Twitch:
+    """
+    Answers get_streams, get_users and get_games from live, a dict from casefolded login to Stream,
+    after waiting latency seconds for each request, like each page of the real client does.
+    A login's user id is "u" followed by the login, as get_users answers,
+    so streams are looked up by user id without scanning live.
+    """
+
+    def __init__(self, live: dict[str, Stream], latency: float):
+        self.live = live
+        self.latency = latency
+        self.calls = {"get_streams": 0, "get_users": 0, "get_games": 0}
+
+    async def get_streams(self, stream_type=None, user_login=None, user_id=None, first=20):
+        self.calls["get_streams"] += 1
+        await asyncio.sleep(self.latency)
+        for login in user_login or []:
+            stream = self.live.get(login.casefold())
+            if stream:
+                yield stream
+        for id in user_id or []:
+            stream = self.live.get(id[1:])
+            if stream and stream.user_id == id:
+                yield stream
+
+    async def get_users(self, logins=None, user_ids=None):
+        self.calls["get_users"] += 1
+        await asyncio.sleep(self.latency)
+        for login in logins or []:
+            yield User(login, "u" + login.casefold())
+        for user_id in user_ids or []:
+            yield User(user_id[1:], user_id)
+
+    async def get_games(self, names=None, game_ids=None):
+        self.calls["get_games"] += 1
+        await asyncio.sleep(self.latency)
+        for name in names or []:
+            yield Game(name)
+        for game_id in game_ids or []:
+            yield Game(game_id[1:])
+
+# ---------------------------------------------------------
+
+# Discord
+
+message_ids = itertools.count(1 << 40)
+
+# Discord API calls made through the fakes, by endpoint
+discord_calls = {"send": 0, "edit": 0, "delete": 0, "history": 0, "add_role": 0, "remove_role": 0}
+
+class Author:
+    def __init__(self, id: int):
+        self.id = id
+
+class Message:
+    def __init__(self, channel: "Channel", content: str | None, embed: discord.Embed | None, author_id: int):
+        self.id = next(message_ids)
+        self.channel = channel
+        self.guild = channel.guild
+        self.content = content
+        self.embeds = [embed] if embed else []
+        self.author = Author(author_id)
+
+    async def edit(self, content=None, embed=None):
+        discord_calls["edit"] += 1
+        self.content = content
+        self.embeds = [embed] if embed else []
+        return self
+
+    async def delete(self):
+        discord_calls["delete"] += 1
+        self.channel.messages.pop(self.id, None)
+
+class Channel(discord.TextChannel):
+    # A real subclass so isinstance checks pass, without calling its constructor
+    def __init__(self, guild: "Guild", id: int, bot_id: int):
+        self.guild = guild
+        self.id = id
+        self.bot_id = bot_id
+        self.messages: dict[int, Message] = {}
+
+    async def history(self, limit=100):
+        discord_calls["history"] += 1
+        for m in list(self.messages.values())[::-1][:limit]:
+            yield m
+
+    async def send(self, content=None, embed=None):
+        discord_calls["send"] += 1
+        m = Message(self, content, embed, self.bot_id)
+        self.messages[m.id] = m
+        return m
+
+    def get_partial_message(self, id: int):
+        return PartialMessage(self, id)
+
+class PartialMessage:
+    def __init__(self, channel: Channel, id: int):
+        self.channel = channel
+        self.id = id
+
+    async def edit(self, content=None, embed=None):
+        m = self.channel.messages.get(self.id)
+        if m is None:
+            discord_calls["edit"] += 1
+            raise discord.NotFound(Response(404), "Unknown Message")
+        return await m.edit(content=content, embed=embed)
+
+    async def delete(self):
+        m = self.channel.messages.get(self.id)
+        if m is None:
+            discord_calls["delete"] += 1
+            raise discord.NotFound(Response(404), "Unknown Message")
+        await m.delete()
+
+class Response:
+    # Enough of an aiohttp response for discord.HTTPException
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = "Not Found"
+
+class Role:
+    def __init__(self, guild: "Guild", id: int):
+        self.guild = guild
+        self.id = id
+        self.name = "role" + str(id)
+        self.members: list[Member] = []
+
+class Asset:
+    def __init__(self, url: str):
+        self.url = url
+
+    def __str__(self):
+        return self.url
+
+class Member:
+    def __init__(self, guild: "Guild", id: int, name: str):
+        self.guild = guild
+        self.id = id
+        self.display_name = name
+        self.display_avatar = Asset("https://cdn.discordapp.com/avatars/" + str(id) + ".png")
+        self.activities: tuple = ()
+        self.roles: list[Role] = []
+
+    def get_role(self, id: int):
+        for r in self.roles:
+            if r.id == id:
+                return r
+        return None
+
+class Guild:
+    def __init__(self, id: int):
+        self.id = id
+        self.name = "guild" + str(id)
+        self.roles: dict[int, Role] = {}
+        self.members: dict[int, Member] = {}
+
+    def get_role(self, id: int):
+        return self.roles.get(id)
+
+    def get_member(self, id: int):
+        return self.members.get(id)
+
+class HTTP:
+    """
+    The raw role routes of discord.Client.http, applied to the guilds by id.
+    """
+
+    def __init__(self, guilds: dict[int, Guild]):
+        self.guilds = guilds
+
+    async def add_role(self, guild_id: int, user_id: int, role_id: int, reason=None):
+        discord_calls["add_role"] += 1
+        guild = self.guilds[guild_id]
+        m = guild.members[user_id]
+        r = guild.roles[role_id]
+        if not r in m.roles:
+            m.roles.append(r)
+            r.members.append(m)
+
+    async def remove_role(self, guild_id: int, user_id: int, role_id: int, reason=None):
+        discord_calls["remove_role"] += 1
+        guild = self.guilds[guild_id]
+        m = guild.members[user_id]
+        r = guild.roles[role_id]
+        if r in m.roles:
+            m.roles.remove(r)
+            r.members.remove(m)
+
+def streaming(login: str, game: str, title: str) -> discord.Streaming:
+    """
+    A Twitch activity, as Discord would send it in a presence update.
+    """
+    return discord.Streaming(name="Twitch", details=title, url="https://www.twitch.tv/" + login, state=game, assets={"large_image": "twitch:" + login.casefold()})
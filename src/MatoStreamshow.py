@@ -2,20 +2,42 @@
 # python src/MatoStreamshow.py
 
 from collections import namedtuple
+from typing import Callable
 
 import aiohttp.client_exceptions
+import argparse
+import asyncio
 import config
+import datetime
 import discord
 from discord import app_commands
 from discord.ext.tasks import loop
-import itertools
+import eventsub
+import hashlib
+import helix
+import imagecache
+import json
+import metrics
+import os
+import poller
 import re
 import save
+import schedule
+import storage
+import sys
+import time
 import traceback
 import twitchAPI.type
+import users
+import writes
 from twitchAPI.twitch import Twitch
 
+# The hash of the command tree last synced, kept next to save.json
+TREE_HASH_PATH = "tree_hash.txt"
+
 api: Twitch | None = None
+stream_events: eventsub.StreamEvents | None = None
+poller_client: poller.PollerClient | None = None
 
 if (not config.twitch_api_id) or config.twitch_api_id == "":
     print("config twitch_api_id not found", flush=True)
@@ -29,6 +51,7 @@ if (not config.twitch_api_secret) or config.twitch_api_secret == "":
 GlobalLiveInfo = namedtuple(
     "GlobalLiveInfo",
     [
+        "game_id",
         "game_name",
         "title",
         "url",
@@ -49,11 +72,38 @@ ServerLiveInfo = namedtuple(
     ],
 )
 
+def intern(s: str | None) -> str | None:
+    """
+    Shares one copy of strings that many live streams repeat, like game names.
+    """
+    return sys.intern(s) if s else s
+
 global_live_infos: dict[str, GlobalLiveInfo] = {}
-global_game_images: dict[str, str] = {}
+# Twitch game box art and profile image URLs, by game name and by casefolded login
+global_game_images: imagecache.ImageCache = imagecache.game_images
+global_profile_images: imagecache.ImageCache = imagecache.profile_images
 server_live_infoss: dict[str, dict[str, ServerLiveInfo]] = {}
-server_channel_msgss: dict[str, dict[str, discord.Message]] = {}
-server_live_memberss: dict[str, dict[str, discord.Member]] = {}
+server_channel_msgss: dict[str, dict[str, "LiveMessage"]] = {}
+# The channel id each guild's server_channel_msgs was seeded from by reading history,
+# after that it's kept current by on_message and the raw message delete events
+server_channel_seeded: dict[str, int] = {}
+# The id of the member given the live role for each streamer name, by guild
+server_live_memberss: dict[str, dict[str, int]] = {}
+# Members with a streamer role and no muted role, by guild and member id,
+# mapped to whether every streamer role they have is filtered by category.
+# Built from role membership, then kept current by on_member_update and on_member_remove.
+server_streamer_candidatess: dict[str, dict[int, bool]] = {}
+# The casefolded Twitch login each of those members is live on, by guild and member id,
+# kept current by on_presence_update
+server_live_member_namess: dict[str, dict[int, str]] = {}
+# Presence updates from members who are already live, waiting out presence_coalesce_seconds,
+# by guild and the login they're live on, to the member with the latest presence
+pending_presences: dict[tuple[str, str], discord.Member] = {}
+presence_flushes: dict[tuple[str, str], asyncio.Task] = {}
+
+# Limits how many Discord API requests are in flight at once, across all guilds,
+# shared with the writes sent by writes.scheduler.
+discord_slots = writes.slots
 
 def parse_twitch_username(s: str) -> str | None:
     m = re.search(r"\s*(.*@|.*twitch.tv/)?(\w+)\s*", s)
@@ -83,6 +133,75 @@ def recover_case(s: str, l: list[str]) -> str:
 
 # ---------------------------------------------------------
 
+# Live registry
+
+# What holds each casefolded login's global_live_infos entry:
+# the guilds with it in their server_live_infoss, and TWITCH while the Twitch API says it's live.
+# The entry is dropped when the last holder lets go, so nothing has to scan every guild for it.
+TWITCH = "twitch"
+live_holders: dict[str, set[str]] = {}
+
+def hold_live(lower_name: str, holder: str):
+    if not lower_name in live_holders:
+        live_holders[lower_name] = set()
+    live_holders[lower_name].add(holder)
+
+def release_live(lower_name: str, holder: str) -> bool:
+    """
+    Lets go of lower_name for holder, dropping its global_live_infos entry if nothing else holds it.
+    Returns whether anything still holds it.
+    """
+    holders = live_holders.get(lower_name)
+    if holders is not None:
+        holders.discard(holder)
+        if holders:
+            return True
+        live_holders.pop(lower_name, None)
+    global_live_infos.pop(lower_name, None)
+    return False
+
+def set_server_live_info(g: str, lower_name: str, info: "ServerLiveInfo"):
+    if not g in server_live_infoss:
+        server_live_infoss[g] = {}
+    server_live_infoss[g][lower_name] = info
+    hold_live(lower_name, g)
+
+def pop_server_live_info(g: str, lower_name: str):
+    if server_live_infoss.get(g, {}).pop(lower_name, None) is not None:
+        release_live(lower_name, g)
+
+def release_twitch_stream(lower_name: str) -> list[str]:
+    """
+    Records that the Twitch API no longer has lower_name live.
+    Drops it from the guilds that only showed it because of that,
+    and keeps its global_live_infos entry only if a Discord activity still shows it somewhere.
+    Returns the guilds it was dropped from.
+    """
+    dropped = [g for g in live_holders.get(lower_name, ()) if g != TWITCH and not server_live_infoss[g][lower_name].has_streamer_role]
+    for g in dropped:
+        pop_server_live_info(g, lower_name)
+    global_info = global_live_infos.get(lower_name)
+    if release_live(lower_name, TWITCH) and global_info and global_info.from_twitch_api:
+        global_live_infos[lower_name] = global_info._replace(from_twitch_api=False)
+    return dropped
+
+def rebuild_live_holders():
+    """
+    Rebuilds live_holders from global_live_infos and server_live_infoss, such as after loading them,
+    and drops the global entries that nothing holds.
+    """
+    live_holders.clear()
+    for g, server_live_infos in server_live_infoss.items():
+        for lower_name in server_live_infos:
+            hold_live(lower_name, g)
+    for lower_name, global_info in list(global_live_infos.items()):
+        if global_info.from_twitch_api:
+            hold_live(lower_name, TWITCH)
+        elif not lower_name in live_holders:
+            global_live_infos.pop(lower_name, None)
+
+# ---------------------------------------------------------
+
 # Discord message output utils
 
 def plain(s: str) -> str:
@@ -99,19 +218,261 @@ def codeblock(s: str, language: str = "") -> str:
 
 # ---------------------------------------------------------
 
+# Discord message rendering
+
+# Everything that's visible in a live message, with empty fields as None.
+# Two renders are equal exactly when the messages would look the same,
+# so comparing them decides whether a message needs to be edited.
+MessageRender = namedtuple(
+    "MessageRender",
+    [
+        "content",
+        "title",
+        "url",
+        "author_name",
+        "author_icon_url",
+        "thumbnail_url",
+        "footer_text",
+        "footer_icon_url",
+        "timestamp",
+    ],
+)
+
+class LiveMessage:
+    """
+    A live message by its ids, with the render last sent to it,
+    or None if that isn't known, so the next update edits it.
+    Edits and deletes go through a PartialMessage, so no discord.Message is kept.
+    """
+    __slots__ = ("id", "channel_id", "render")
+
+    def __init__(self, id: int, channel_id: int, render: MessageRender | None):
+        self.id = id
+        self.channel_id = channel_id
+        self.render = render
+
+    @classmethod
+    def of_message(cls, m: discord.Message) -> "LiveMessage":
+        return cls(m.id, m.channel.id, render_of_message(m))
+
+    def partial(self) -> discord.PartialMessage:
+        return bot.get_partial_messageable(self.channel_id).get_partial_message(self.id)
+
+def render_message(name: str, cap_name: str, server_info: ServerLiveInfo | None) -> MessageRender | None:
+    if server_info is None or not name in global_live_infos:
+        return None
+    global_info = global_live_infos[name]
+    plain_game = plain(global_info.game_name) if global_info.game_name else ""
+    text = "**" + plain(server_info.display_name) + "** is live!" + ((" Playing " + plain_game) if global_info.game_name else "")
+    thumb = global_info.thumbnail_url or guess_thumbnail_url(name, thumbnail_url_template)
+    icon = server_info.display_avatar or global_info.profile_image_url
+    game_icon = global_info.game_image_url or global_game_images.get(global_info.game_name)
+    return MessageRender(
+        content=text,
+        title=plain(global_info.title) or None,
+        url=global_info.url or None,
+        author_name=cap_name,
+        author_icon_url=str(icon) if icon else None,
+        thumbnail_url=thumb or None,
+        footer_text=plain_game or None,
+        footer_icon_url=game_icon or None,
+        timestamp=global_info.started_at or None,
+    )
+
+def render_of_message(m: discord.Message) -> MessageRender | None:
+    """
+    Reads the render back out of a message that was already posted,
+    such as one found in the channel history after a restart.
+    """
+    if len(m.embeds) == 0:
+        return None
+    embed = m.embeds[0]
+    return MessageRender(
+        content=m.content,
+        title=embed.title or None,
+        url=embed.url or None,
+        author_name=embed.author.name,
+        author_icon_url=embed.author.icon_url or None,
+        thumbnail_url=embed.thumbnail.url or None,
+        footer_text=embed.footer.text or None,
+        footer_icon_url=embed.footer.icon_url or None,
+        timestamp=embed.timestamp or None,
+    )
+
+def render_embed(render: MessageRender) -> discord.Embed:
+    embed = discord.Embed(colour=discord.Colour.purple(), title=render.title, url=render.url)
+    embed.set_author(name=render.author_name, url=render.url, icon_url=render.author_icon_url)
+    embed.set_thumbnail(url=render.thumbnail_url)
+    embed.set_footer(text=render.footer_text or "", icon_url=render.footer_icon_url)
+    if render.timestamp:
+        embed.timestamp = render.timestamp
+    return embed
+
+# ---------------------------------------------------------
+
+# Discord streamer members
+
+def streamer_candidate_filter(view: save.GuildView, m: discord.Member) -> bool | None:
+    """
+    Returns whether the category filter applies to m,
+    or None if m has no streamer role or has a muted role.
+    """
+    if has_any_of_role_ids(m, view.muted_role_ids):
+        return None
+    result = None
+    for dsr_id in view.streamer_role_ids:
+        if m.get_role(dsr_id):
+            if not dsr_id in view.filtered_role_ids:
+                return False
+            result = True
+    return result
+
+def build_streamer_candidates(g: str, view: save.GuildView, guild: discord.Guild) -> dict[int, bool]:
+    """
+    Rebuilds server_streamer_candidatess[g] from the members of each streamer role,
+    looking at each member once no matter how many streamer roles they have.
+    """
+    members: dict[int, discord.Member] = {}
+    for dsr_id in view.streamer_role_ids:
+        dsr = guild.get_role(dsr_id)
+        if not dsr:
+            continue
+        for m in dsr.members:
+            members[m.id] = m
+    candidates: dict[int, bool] = {}
+    for m in members.values():
+        filtered = streamer_candidate_filter(view, m)
+        if filtered is not None:
+            candidates[m.id] = filtered
+    server_streamer_candidatess[g] = candidates
+    return candidates
+
+def member_twitch_stream(m: discord.Member, filtered: bool, cats: frozenset[str]) -> discord.Streaming | None:
+    """
+    Returns m's Twitch stream if it should be shown, given the casefolded categories to filter by.
+    """
+    for a in m.activities:
+        if isinstance(a, discord.Streaming) and a.platform == "Twitch":
+            if (not filtered) or len(cats) == 0 or (a.game and a.game.casefold() in cats):
+                if not a.twitch_name:
+                    continue
+                return a
+            return None
+    return None
+
+def record_discord_stream(g: str, m: discord.Member, a: discord.Streaming) -> str:
+    """
+    Records that m is live on Twitch according to Discord, and returns the casefolded login.
+    """
+    assert a.twitch_name
+    lower_name = a.twitch_name.casefold()
+    thumb = None
+    profile_image = None
+    from_twitch = False
+    global_info = global_live_infos.get(lower_name)
+    if global_info:
+        thumb = global_info.thumbnail_url
+        profile_image = global_info.profile_image_url
+        from_twitch = global_info.from_twitch_api
+    # Presence updates repeat the same stream over and over, so only replace what changed
+    if not (global_info and global_info.game_name == a.game and global_info.title == a.name and global_info.url == a.url and global_info.started_at == a.created_at):
+        global_live_infos[lower_name] = GlobalLiveInfo(
+            game_id=None,
+            game_name=intern(a.game),
+            title=intern(a.name),
+            url=a.url,
+            thumbnail_url=thumb,
+            profile_image_url=profile_image,
+            started_at=a.created_at,
+            game_image_url=a.game and global_game_images.get(a.game),
+            from_twitch_api=from_twitch,
+        )
+    avatar = m.display_avatar.url
+    server_info = server_live_infoss.get(g, {}).get(lower_name)
+    if not (server_info and server_info.has_streamer_role and server_info.display_name == m.display_name and server_info.display_avatar == avatar):
+        set_server_live_info(g, lower_name, ServerLiveInfo(
+            display_name=m.display_name,
+            display_avatar=avatar,
+            has_streamer_role=True,
+        ))
+    if not g in server_live_member_namess:
+        server_live_member_namess[g] = {}
+    server_live_member_namess[g][m.id] = lower_name
+    return lower_name
+
+# ---------------------------------------------------------
+
 # Main MatoStreamshow class
 
-class MatoStreamshow(discord.Client):
+class MatoStreamshow(discord.AutoShardedClient):
     def __init__(self, *, intents: discord.Intents) -> None:
-        super().__init__(intents=intents)
+        # With neither set, Discord picks how many shards to run, all in this process
+        super().__init__(intents=intents, shard_count=config.shard_count, shard_ids=config.shard_ids, http_trace=metrics.discord_trace())
+        self.metrics_runner = None
+        # Set by --force-sync, to sync the commands even if they haven't changed
+        self.force_sync = False
         self.tree = app_commands.CommandTree(self)
         self.countdown = 0
         self.countreset = 10
+        self.auditdown = 0
+        self.auditreset = config.member_audit_ticks
+        self.rescandown = 0
+        self.rescanreset = config.history_rescan_ticks
+        self.reconciledown = 0
+        self.reconcilereset = config.eventsub_reconcile_ticks
+        self.snapshotdown = config.live_state_ticks
+        self.snapshotreset = config.live_state_ticks
 
     async def setup_hook(self):
-        await self.tree.sync()
+        # Commands are global, so only one process needs to sync them
+        if self.shard_ids is None or 0 in self.shard_ids:
+            await self.sync_tree()
+        if load_live_state():
+            # The messages were known when the snapshot was taken, so the first tick doesn't need to read history.
+            # One deleted while the bot was down is posted again when its edit fails, or by the next rescan
+            self.rescandown = self.rescanreset
+        self.setup_poller()
+        self.metrics_runner = await metrics.start_server()
         await bot.setup_twitch()
 
+    def tree_hash(self) -> str:
+        """
+        A hash of the commands as they're sent to Discord, which changes exactly when they need syncing.
+        """
+        commands = [c.to_dict(self.tree) for c in self.tree.get_commands()]
+        text = json.dumps({"application_id": self.application_id, "commands": commands}, sort_keys=True)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    async def sync_tree(self):
+        """
+        Syncs the commands, unless they're the same as the last time they were synced.
+        Syncing is slow and heavily rate limited, so restarts skip it when they can.
+        """
+        tree_hash = self.tree_hash()
+        if not self.force_sync and os.path.exists(TREE_HASH_PATH):
+            with open(TREE_HASH_PATH) as f:
+                if f.read().strip() == tree_hash:
+                    print("Commands unchanged since the last sync, not syncing", flush=True)
+                    return
+        await self.tree.sync()
+        with open(TREE_HASH_PATH, "w") as f:
+            f.write(tree_hash + "\n")
+
+    async def close(self):
+        if stream_events:
+            await stream_events.stop()
+        if poller_client:
+            await poller_client.stop()
+        if self.metrics_runner:
+            await self.metrics_runner.cleanup()
+        await writes.scheduler.drain()
+        await write_live_state()
+        await imagecache.flush()
+        if not poller_client:
+            await schedule.poll_schedule.flush()
+        await save.flush()
+        await super().close()
+
     async def setup_twitch(self):
         global api
         if api is not None:
@@ -121,6 +482,55 @@ class MatoStreamshow(discord.Client):
             print("Setup attempted when twitch api info not present, ignoring", flush=True)
             return
         api = await Twitch(config.twitch_api_id, config.twitch_api_secret, True, [])
+        await self.setup_stream_events()
+
+    def setup_poller(self):
+        global poller_client
+        if not config.poller_socket or poller_client:
+            return
+        poller_client = poller.PollerClient(config.poller_socket, on_poller_update)
+        poller_client.set_watch(save.get_lower_set_all(), save.get_priority_set(), save.user_ids)
+        poller_client.start()
+
+    async def setup_stream_events(self):
+        global stream_events
+        # The poller has its own EventSub subscriptions if it's set up for them
+        if not config.eventsub_mode or not api or poller_client:
+            return
+        try:
+            if config.eventsub_mode == "websocket":
+                await api.set_user_authentication(config.twitch_user_token, [], config.twitch_user_refresh_token)
+            stream_events = eventsub.StreamEvents(api, on_twitch_stream_online, on_twitch_stream_offline)
+            await stream_events.start()
+        except Exception as e:
+            print("Could not start Twitch EventSub, polling instead", flush=True)
+            traceback.print_exception(e)
+            stream_events = None
+            return
+        self.sync_stream_events()
+
+    def sync_stream_events(self):
+        """
+        Starts updating the EventSub subscriptions, or what the poller polls, to match the watched streamers.
+        """
+        if stream_events:
+            asyncio.create_task(stream_events.sync(save.get_lower_set_all(), save.user_ids))
+        if poller_client:
+            poller_client.set_watch(save.get_lower_set_all(), save.get_priority_set(), save.user_ids)
+
+    @loop(minutes=60)
+    async def RefreshTwitchUsers(self):
+        """
+        Follows renamed Twitch accounts, and stops polling deleted ones.
+        """
+        if not api:
+            return
+        try:
+            if await users.refresh_stale(api):
+                self.sync_stream_events()
+        except Exception as e:
+            print("Error in RefreshTwitchUsers", flush=True)
+            traceback.print_exception(e)
 
     @loop(minutes=1)
     async def TwitchListen(self):
@@ -132,183 +542,156 @@ class MatoStreamshow(discord.Client):
         global server_live_memberss
         global_valid_keys: set[str] = set()
         server_valid_keyss: dict[str, set[str]] = {}
+        tick_start = time.perf_counter()
+        t = tick_start
         try:
 
             #region Discord activity presence and roles
 
             listened_discord = False
-            if 0 < self.countdown:
+            # Every so often, rebuild the streamer members from role membership
+            # and check all of them, in case a role or presence update was missed.
+            # In between, only the members already known to be live are looked at.
+            audit = False
+            if 0 < self.auditdown:
+                self.auditdown -= 1
+            else:
+                self.auditdown = self.auditreset
+                audit = True
+            if 0 < self.countdown and not audit:
                 self.countdown -= 1
             else:
                 self.countdown = self.countreset
-                for g in save.get_guild_ids():
-                    d = save.get_guild_data(g)
-                    dc_id = d["channel_id"]
-                    if not (dc_id and dc_id != 0):
+                for g in save.get_owned_guild_ids():
+                    view = save.get_guild_view(g)
+                    if view.channel_id == 0:
                         continue
-                    cats = d["twitch_category_list"]
-                    if not "streamer_roles" in d:
-                        d["streamer_roles"] = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
-                    streamer_roles = d["streamer_roles"]
-                    if not "muted_role_list" in d:
-                        d["muted_role_list"] = []
-                    muted_role_list = d["muted_role_list"]
-                    dlr_id = d["live_role_id"]
-                    if not g in server_live_infoss:
-                        server_live_infoss[g] = {}
-                    server_live_infos = server_live_infoss[g]
+                    d = save.get_guild_data(g)
+                    cats = view.categories
+                    dlr_id = view.live_role_id
                     if not g in server_valid_keyss:
                         server_valid_keyss[g] = set()
                     server_valid_keys = server_valid_keyss[g]
-                    streamer_members: set[discord.Member] = set()
                     if not g in server_live_memberss:
                         server_live_memberss[g] = {}
                     server_live_members = server_live_memberss[g]
-                    live_members: dict[discord.Member, str] = {}
+                    if not g in server_live_member_namess:
+                        server_live_member_namess[g] = {}
+                    live_member_names = server_live_member_namess[g]
                     guild = self.get_guild(int(g))
                     if not guild:
                         continue
-                    for role_id_str, filtered in streamer_roles.items():
-                        dsr = guild.get_role(int(role_id_str))
-                        if not dsr:
+                    full_scan = audit or not g in server_streamer_candidatess
+                    if full_scan:
+                        candidates = build_streamer_candidates(g, view, guild)
+                        # Also the members that aren't candidates anymore but were live or still have the live role,
+                        # such as ones who lost their streamer role, so their entries and live role are cleared
+                        audited = set(candidates.keys())
+                        audited.update(live_member_names.keys())
+                        dlr = guild.get_role(dlr_id) if dlr_id else None
+                        if dlr:
+                            audited.update((m.id for m in dlr.members))
+                        member_ids = list(audited)
+                    else:
+                        candidates = server_streamer_candidatess[g]
+                        member_ids = list(live_member_names.keys())
+                    for member_id in member_ids:
+                        m = guild.get_member(member_id)
+                        a = m and member_id in candidates and member_twitch_stream(m, candidates[member_id], cats)
+                        if not (m and a):
+                            live_member_names.pop(member_id, None)
                             continue
-                        for m in dsr.members:
-                            if not has_any_of_role_ids(m, muted_role_list):
-                                streamer_members.add(m)
-                        for m in streamer_members:
-                            for a in m.activities:
-                                if isinstance(a, discord.Streaming) and a.platform == "Twitch":
-                                    if (not filtered) or len(cats) == 0 or a.game in cats:
-                                        if not a.twitch_name:
-                                            continue
-                                        lower_name = a.twitch_name.casefold()
-                                        live_members[m] = lower_name
-                                        server_live_members[lower_name] = m
-                                        thumb = None
-                                        profile_image = None
-                                        from_twitch = False
-                                        if lower_name in global_live_infos:
-                                            global_info = global_live_infos[lower_name]
-                                            thumb = global_info.thumbnail_url
-                                            profile_image = global_info.profile_image_url
-                                            from_twitch = global_info.from_twitch_api
-                                        global_live_infos[lower_name] = GlobalLiveInfo(
-                                            game_name=a.game,
-                                            title=a.name,
-                                            url=a.url,
-                                            thumbnail_url=thumb,
-                                            profile_image_url=profile_image,
-                                            started_at=a.created_at,
-                                            game_image_url=a.game and global_game_images.get(a.game),
-                                            from_twitch_api=from_twitch,
-                                        )
-                                        server_live_infos[lower_name] = ServerLiveInfo(
-                                            display_name=m.display_name,
-                                            display_avatar=m.display_avatar,
-                                            has_streamer_role=True,
-                                        )
-                                        global_valid_keys.add(lower_name)
-                                        server_valid_keys.add(lower_name)
-                                    break
+                        lower_name = record_discord_stream(g, m, a)
+                        server_live_members[lower_name] = member_id
+                        global_valid_keys.add(lower_name)
+                        server_valid_keys.add(lower_name)
                     if not (dlr_id and dlr_id != 0):
                         continue
-                    try:
-                        dlr = guild.get_role(dlr_id)
-                        if dlr:
-                            for m in streamer_members:
-                                if m in live_members:
-                                    if not m.get_role(dlr_id):
-                                        server_live_members[live_members[m]] = m
-                                        await m.add_roles(dlr, reason="Streaming Live")
-                                else:
-                                    if m.get_role(dlr_id):
-                                        for k, v in server_live_members.items():
-                                            if v.id == m.id:
-                                                server_live_members.pop(k, None)
-                                                break
-                                        await m.remove_roles(dlr, reason="Not Streaming Live")
-                    except discord.Forbidden as e:
-                        print("MatoStreamshow needs permission to manage the live role in:")
-                        print("  Server name: " + d["name"])
-                        print("  Role id: " + str(dlr_id), flush=True)
-                        traceback.print_exception(e)
+                    dlr = guild.get_role(dlr_id)
+                    if dlr:
+                        for member_id in member_ids:
+                            m = guild.get_member(member_id)
+                            if not m:
+                                continue
+                            if member_id in live_member_names:
+                                if not m.get_role(dlr_id):
+                                    server_live_members[live_member_names[member_id]] = member_id
+                                    add_live_role(d, guild.id, member_id, dlr_id)
+                            else:
+                                if m.get_role(dlr_id):
+                                    for k, v in server_live_members.items():
+                                        if v == member_id:
+                                            server_live_members.pop(k, None)
+                                            break
+                                    remove_live_role(d, guild.id, member_id, dlr_id)
                 listened_discord = True
 
             #endregion Discord activity presence and roles
 
+            if listened_discord:
+                metrics.region_done("discord_presence", t)
+            t = time.perf_counter()
             lower_set_all: set[str] = save.get_lower_set_all()
 
             #region Twitch streams
 
             hadTwitchBackendException = False
+            poll_twitch = True
+            if stream_events:
+                # With EventSub, polling is only a fallback to reconcile missed events
+                if 0 < self.reconciledown:
+                    self.reconciledown -= 1
+                    poll_twitch = False
+                else:
+                    self.reconciledown = self.reconcilereset
+                    self.sync_stream_events()
+            if not poll_twitch:
+                # stream.online and stream.offline events keep these current between polls
+                global_valid_keys.update((n for n, i in global_live_infos.items() if i.from_twitch_api and n in lower_set_all))
             try:
-                if api:
-                    for batch in itertools.batched(lower_set_all, 100):
-                        streams = api.get_streams(stream_type="live", user_login=list(batch), first=100)
-                        async for stream in streams:
-                            thumb = stream.thumbnail_url.replace("{width}", "320").replace("{height}", "180")
-                            if not thumbnail_url_template:
-                                template = guess_thumbnail_url_template(stream.user_name, thumb)
-                                if template and (not template in invalid_thumbnail_url_templates):
-                                    thumbnail_url_template = template
-                                    print("current thumbnail_url_template: " + thumbnail_url_template, flush=True)
-                            elif guess_thumbnail_url(stream.user_name, thumbnail_url_template) != thumb:
-                                print("invalid thumbnail_url_template: " + thumbnail_url_template, flush=True)
-                                invalid_thumbnail_url_templates.append(thumbnail_url_template)
-                                thumbnail_url_template = None
-                            url = "https://www.twitch.tv/" + stream.user_name
-                            lower_name = stream.user_name.casefold()
-                            if not lower_name in global_valid_keys:
-                                global_live_infos[lower_name] = GlobalLiveInfo(
-                                    game_name=stream.game_name,
-                                    title=stream.title,
-                                    url=url,
-                                    thumbnail_url=thumb,
-                                    profile_image_url=global_live_infos[lower_name].profile_image_url if lower_name in global_live_infos else None,
-                                    started_at=stream.started_at,
-                                    game_image_url=stream.game_name and global_game_images.get(stream.game_name),
-                                    from_twitch_api=True,
-                                )
-                                global_valid_keys.add(lower_name)
-                        for lower_name in batch:
-                            if not lower_name in global_valid_keys:
-                                global_live_infos.pop(lower_name, None)
+                # Only logins with a user id are polled, so new ones are resolved first
+                if api and await users.resolve_new(api):
+                    self.sync_stream_events()
+                if poller_client:
+                    # The poller process does the polling, this only reads what it last published
+                    if poller_client.connected():
+                        merge_twitch_streams(*poller_client.batch(lower_set_all), global_valid_keys)
+                    else:
+                        hadTwitchBackendException = True
+                elif api and poll_twitch:
+                    due = schedule.poll_schedule.due(lower_set_all, save.get_priority_set())
+                    # The ones that aren't due keep what the last poll of them found
+                    global_valid_keys.update((n for n, i in global_live_infos.items() if i.from_twitch_api and n in lower_set_all and not n in due))
+                    batch_results = await helix.gather_streams_by_id(api, due, save.user_ids)
+                    batch_errors: list[BaseException] = []
+                    for batch, streams in batch_results:
+                        if isinstance(streams, BaseException):
+                            batch_errors.append(streams)
+                            continue
+                        merge_twitch_streams(batch, streams, global_valid_keys)
+                    # Every batch that succeeded has been merged,
+                    # now report the first one that didn't
+                    if batch_errors:
+                        raise batch_errors[0]
             except twitchAPI.type.TwitchBackendException as e:
                 hadTwitchBackendException = True
                 print("Twitch API Server Error in TwitchListen", flush=True)
                 traceback.print_exception(e)
+            # Names no guild watches anymore, such as the old name of a renamed account, won't be polled again
+            for lower_name in [n for n, i in global_live_infos.items() if i.from_twitch_api and not n in lower_set_all]:
+                release_twitch_stream(lower_name)
 
             #endregion Twitch streams
 
-            for g in save.get_guild_ids():
-                d = save.get_guild_data(g)
-                dc_id = d["channel_id"]
-                if not (dc_id and dc_id != 0):
-                    continue
-                if not g in server_live_infoss:
-                    server_live_infoss[g] = {}
-                server_live_infos = server_live_infoss[g]
-                if not g in server_valid_keyss:
-                    server_valid_keyss[g] = set()
-                server_valid_keys = server_valid_keyss[g]
-                cap_l = d["twitch_streamer_list"]
-                cats = d["twitch_category_list"]
-                for cap_name in cap_l:
-                    lower_name = cap_name.casefold()
-                    if lower_name in global_valid_keys:
-                        stream = global_live_infos[lower_name]
-                        if not lower_name in server_valid_keys:
-                            if len(cats) == 0 or stream.game_name in cats:
-                                if not lower_name in server_live_infos:
-                                    server_live_infos[lower_name] = ServerLiveInfo(
-                                        display_name=cap_name,
-                                        display_avatar=None,
-                                        has_streamer_role=False,
-                                    )
-                                server_valid_keys.add(lower_name)
-                            elif (lower_name in server_live_infos) and (not server_live_infos[lower_name].has_streamer_role):
-                                server_live_infos.pop(lower_name, None)
-                if not hadTwitchBackendException:
+            t = metrics.region_done("twitch_streams", t)
+            for lower_name in global_valid_keys:
+                fan_out_stream(lower_name, server_valid_keyss)
+            if not hadTwitchBackendException:
+                for g, server_live_infos in server_live_infoss.items():
+                    dc_id = save.get_guild_data(g)["channel_id"]
+                    if not (dc_id and dc_id != 0):
+                        continue
+                    server_valid_keys = server_valid_keyss.get(g, set())
                     for lower_name in set(server_live_infos.keys()):
                         # This condition is here to avoid deleting
                         # entries from Discord that weren't from Twitch,
@@ -316,7 +699,8 @@ class MatoStreamshow(discord.Client):
                         # Only delete entries when either listened_discord,
                         # or it's not from Twitch.
                         if (not lower_name in server_valid_keys) and (listened_discord or ((not server_live_infos[lower_name].has_streamer_role) and (not (lower_name in global_live_infos and global_live_infos[lower_name].from_twitch_api)))):
-                            server_live_infos.pop(lower_name, None)
+                            pop_server_live_info(g, lower_name)
+            t = metrics.region_done("fan_out", t)
 
             #region Twitch profile image avatars
 
@@ -325,77 +709,37 @@ class MatoStreamshow(discord.Client):
 
             #endregion Twitch profile image avatars
 
+            t = metrics.region_done("profile_images", t)
             if not await ensure_game_images():
                 hadTwitchBackendException = True
+            await imagecache.flush()
+            t = metrics.region_done("game_images", t)
 
             #region Discord messages
 
-            for g in save.get_guild_ids():
-                d = save.get_guild_data(g)
-                dc_id = d["channel_id"]
-                if not (dc_id and dc_id != 0):
-                    continue
-                cap_l = d["twitch_streamer_list"]
-                if not g in server_live_infoss:
-                    server_live_infoss[g] = {}
-                server_live_infos = server_live_infoss[g]
-                if not g in server_live_memberss:
-                    server_live_memberss[g] = {}
-                server_live_members = server_live_memberss[g]
-                dc = bot.get_channel(dc_id)
-                if not isinstance(dc, discord.TextChannel):
-                    continue
-                if not g in server_channel_msgss:
-                    server_channel_msgss[g] = {}
-                server_channel_msgs = server_channel_msgss[g]
-                try:
-                    async for m in dc.history():
-                        if self.user and m.author.id == self.user.id and 1 <= len(m.embeds):
-                            cap_name = m.embeds[0].author.name
-                            if not cap_name:
-                                continue
-                            name = cap_name.casefold()
-                            if name in server_channel_msgs:
-                                if server_channel_msgs[name].id != m.id:
-                                    # ** there can only be one! **
-                                    await m.delete()
-                            else:
-                                server_channel_msgs[name] = m
-                except discord.Forbidden as e:
-                    print("MatoStreamshow needs permission to read message history in:")
-                    print("  Server name: " + d["name"])
-                    print("  Channel id: " + str(dc_id), flush=True)
-                    traceback.print_exception(e)
-                try:
-                    for name in server_live_infos.keys():
-                        await ensure_message(g, name)
-                except discord.Forbidden as e:
-                    print("MatoStreamshow needs permission to send messages in:")
-                    print("  Server name: " + d["name"])
-                    print("  Channel id: " + str(dc_id), flush=True)
-                    traceback.print_exception(e)
-                if not hadTwitchBackendException:
-                    for name in set(server_channel_msgs.keys()):
-                        if not name in server_live_infos:
-                            await server_channel_msgs[name].delete()
-                            server_channel_msgs.pop(name, None)
-                            if name in server_live_members:
-                                guild = self.get_guild(int(g))
-                                dlr_id = d["live_role_id"]
-                                try:
-                                    if dlr_id and dlr_id != 0:
-                                        dlr = guild and guild.get_role(dlr_id)
-                                        if dlr:
-                                            await server_live_members[name].remove_roles(dlr)
-                                            server_live_members.pop(name, None)
-                                except discord.Forbidden as e:
-                                    print("MatoStreamshow needs permission to manage the live role in:")
-                                    print("  Server name: " + d["name"])
-                                    print("  Role id: " + str(dlr_id), flush=True)
-                                    traceback.print_exception(e)
+            rescan = False
+            if 0 < self.rescandown:
+                self.rescandown -= 1
+            else:
+                self.rescandown = self.rescanreset
+                rescan = True
+            if rescan and not poller_client:
+                await schedule.poll_schedule.flush()
+            owned_guild_ids = save.get_owned_guild_ids()
+            await asyncio.gather(*(self.render_guild_messages(g, hadTwitchBackendException, rescan) for g in owned_guild_ids))
 
             #endregion Discord messages
 
+            t = metrics.region_done("discord_messages", t)
+            metrics.set_gauge("guilds_processed", len(owned_guild_ids))
+            metrics.set_gauge("watched_streamers", len(lower_set_all))
+            metrics.set_gauge("live_streamers", len(global_live_infos))
+            if 0 < self.snapshotdown:
+                self.snapshotdown -= 1
+            else:
+                self.snapshotdown = self.snapshotreset
+                await write_live_state()
+
         except discord.DiscordServerError as e:
             print("Discord Server Error in TwitchListen", flush=True)
             traceback.print_exception(e)
@@ -405,122 +749,434 @@ class MatoStreamshow(discord.Client):
         except discord.HTTPException as e:
             print("HTTP Exception in TwitchListen", flush=True)
             traceback.print_exception(e)
-
-    async def on_presence_update(self, _: discord.Member, m: discord.Member):
-        global global_live_infos
-        global global_game_images
+        finally:
+            metrics.tick_done(tick_start, (self.TwitchListen.minutes or 1) * 60)
+
+    async def render_guild_messages(self, g: str, hadTwitchBackendException: bool, rescan: bool):
+        """
+        Brings the messages in one guild's channel up to date.
+        Each guild runs as its own worker, in order within its channel,
+        and its errors are reported here instead of stopping other guilds.
+        Channel history is only read to seed the message cache,
+        or to check it for consistency when rescan is set.
+        """
         global server_live_infoss
-        global server_live_memberss
-        guild = m.guild
-        g = str(guild.id)
+        global server_channel_msgss
+        global server_channel_seeded
         d = save.get_guild_data(g)
         dc_id = d["channel_id"]
         if not (dc_id and dc_id != 0):
             return
-        if not "streamer_roles" in d:
-            d["streamer_roles"] = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
-        streamer_roles = d["streamer_roles"]
-        if not "muted_role_list" in d:
-            d["muted_role_list"] = []
-        muted_role_list = d["muted_role_list"]
-        if has_any_of_role_ids(m, muted_role_list):
-            return
-        cats = d["twitch_category_list"]
-        dlr_id = d["live_role_id"]
         if not g in server_live_infoss:
             server_live_infoss[g] = {}
         server_live_infos = server_live_infoss[g]
+        dc = bot.get_channel(dc_id)
+        if not isinstance(dc, discord.TextChannel):
+            return
+        if not g in server_channel_msgss:
+            server_channel_msgss[g] = {}
+        server_channel_msgs = server_channel_msgss[g]
+        try:
+            try:
+                if server_channel_seeded.get(g) != dc_id:
+                    if g in server_channel_seeded:
+                        # The channel changed, so the old messages aren't in it
+                        server_channel_msgs.clear()
+                    rescan = True
+                if rescan:
+                    before = dict(server_channel_msgs)
+                    # Every live message in the history, by streamer name, newest first
+                    found: dict[str, list[discord.Message]] = {}
+                    async with discord_slots:
+                        async for m in dc.history():
+                            name = self.live_message_name(m)
+                            if not name:
+                                continue
+                            if not name in found:
+                                found[name] = []
+                            found[name].append(m)
+                    # Rebuild from the history, so messages deleted while a delete event was missed are forgotten,
+                    # keeping the render of the ones still there, and any posted while the history was read
+                    rebuilt: dict[str, LiveMessage] = {}
+                    duplicates: list[LiveMessage] = []
+                    for name, ms in found.items():
+                        cached = server_channel_msgs.get(name)
+                        keep = next((m for m in ms if cached and m.id == cached.id), ms[0])
+                        rebuilt[name] = cached if cached and cached.id == keep.id else LiveMessage.of_message(keep)
+                        # ** there can only be one! **
+                        duplicates.extend((LiveMessage(m.id, dc_id, None) for m in ms if m.id != keep.id))
+                    for name, m in server_channel_msgs.items():
+                        if not name in rebuilt and before.get(name) is not m:
+                            rebuilt[name] = m
+                    server_channel_msgs.clear()
+                    server_channel_msgs.update(rebuilt)
+                    server_channel_seeded[g] = dc_id
+                    for m in duplicates:
+                        delete_message(d, m)
+            except discord.Forbidden as e:
+                print("MatoStreamshow needs permission to read message history in:")
+                print("  Server name: " + d["name"])
+                print("  Channel id: " + str(dc_id), flush=True)
+                traceback.print_exception(e)
+            for name in list(server_live_infos.keys()):
+                await ensure_message(g, name)
+            if not hadTwitchBackendException:
+                for name in set(server_channel_msgs.keys()):
+                    if not name in server_live_infos:
+                        remove_live_message(g, name)
+        except discord.DiscordServerError as e:
+            print("Discord Server Error in TwitchListen for server name: " + d["name"], flush=True)
+            traceback.print_exception(e)
+        except aiohttp.client_exceptions.ClientError as e:
+            print("Client Error in TwitchListen for server name: " + d["name"], flush=True)
+            traceback.print_exception(e)
+        except discord.HTTPException as e:
+            print("HTTP Exception in TwitchListen for server name: " + d["name"], flush=True)
+            traceback.print_exception(e)
+
+    def live_message_name(self, m: discord.Message) -> str | None:
+        """
+        Returns the casefolded streamer name if m is one of this bot's live messages.
+        """
+        if self.user and m.author.id == self.user.id and 1 <= len(m.embeds):
+            cap_name = m.embeds[0].author.name
+            if cap_name:
+                return cap_name.casefold()
+        return None
+
+    async def on_message(self, m: discord.Message):
+        global server_channel_msgss
+        if m.guild is None:
+            return
+        name = self.live_message_name(m)
+        if not name:
+            return
+        g = str(m.guild.id)
+        if server_channel_seeded.get(g) != m.channel.id:
+            return
+        if not g in server_channel_msgss:
+            server_channel_msgss[g] = {}
+        server_channel_msgs = server_channel_msgss[g]
+        # Duplicates are left for the next history rescan to clean up
+        if not name in server_channel_msgs:
+            server_channel_msgs[name] = LiveMessage.of_message(m)
+
+    def forget_messages(self, guild_id: int | None, message_ids: set[int]):
+        global server_channel_msgss
+        if guild_id is None:
+            return
+        server_channel_msgs = server_channel_msgss.get(str(guild_id))
+        if not server_channel_msgs:
+            return
+        for name, m in list(server_channel_msgs.items()):
+            if m.id in message_ids:
+                server_channel_msgs.pop(name, None)
+
+    async def on_raw_message_delete(self, payload: discord.RawMessageDeleteEvent):
+        self.forget_messages(payload.guild_id, {payload.message_id})
+
+    async def on_raw_bulk_message_delete(self, payload: discord.RawBulkMessageDeleteEvent):
+        self.forget_messages(payload.guild_id, payload.message_ids)
+
+    async def on_presence_update(self, _: discord.Member, m: discord.Member):
+        start = time.perf_counter()
+        if self.presence_irrelevant(m):
+            metrics.region_done("presence_dropped", start)
+            return
+        key = self.presence_coalesce_key(m)
+        if key:
+            pending_presences[key] = m
+            if not key in presence_flushes:
+                presence_flushes[key] = asyncio.create_task(self.flush_presence(key))
+            metrics.region_done("presence_coalesced", start)
+            return
+        try:
+            await self.handle_presence_update(m)
+        finally:
+            metrics.region_done("presence_update", start)
+
+    def presence_coalesce_key(self, m: discord.Member) -> tuple[str, str] | None:
+        """
+        The key to hold m's presence update under until the coalescing window is over,
+        or None to apply it straight away, when m is going live or coalescing is off.
+        """
+        if config.presence_coalesce_seconds <= 0:
+            return None
+        g = str(m.guild.id)
+        lower_name = server_live_member_namess.get(g, {}).get(m.id)
+        if lower_name is None:
+            return None
+        return (g, lower_name)
+
+    async def flush_presence(self, key: tuple[str, str]):
+        """
+        Applies the latest presence update held under key, once the coalescing window is over.
+        """
+        try:
+            await asyncio.sleep(config.presence_coalesce_seconds)
+            presence_flushes.pop(key, None)
+            m = pending_presences.pop(key, None)
+            if m is None:
+                return
+            start = time.perf_counter()
+            try:
+                await self.handle_presence_update(m)
+            finally:
+                metrics.region_done("presence_update", start)
+        except Exception as e:
+            print("Error applying a presence update", flush=True)
+            traceback.print_exception(e)
+
+    def presence_irrelevant(self, m: discord.Member) -> bool:
+        """
+        Whether a presence update of m can't change anything,
+        because m wasn't live before and isn't streaming or isn't a streamer candidate now.
+        Builds the guild's streamer candidates the first time, so after that this is a few dict lookups.
+        """
+        g = str(m.guild.id)
+        if save.get_guild_view(g).channel_id == 0:
+            return True
+        if m.id in server_live_member_namess.get(g, ()):
+            return False
+        for a in m.activities:
+            if isinstance(a, discord.Streaming):
+                break
+        else:
+            return True
+        candidates = server_streamer_candidatess.get(g)
+        if candidates is None:
+            candidates = build_streamer_candidates(g, save.get_guild_view(g), m.guild)
+        return not m.id in candidates
+
+    async def handle_presence_update(self, m: discord.Member):
+        global global_live_infos
+        global server_live_infoss
+        global server_live_memberss
+        guild = m.guild
+        g = str(guild.id)
+        view = save.get_guild_view(g)
+        d = save.get_guild_data(g)
+        cats = view.categories
+        dlr_id = view.live_role_id
         if not g in server_live_memberss:
             server_live_memberss[g] = {}
         server_live_members = server_live_memberss[g]
-        is_live = False
-        lower_name = None
-        for role_id_str, filtered in streamer_roles.items():
-            dsr_id = int(role_id_str)
-            if not (dsr_id and dsr_id != 0):
-                continue
-            if not m.get_role(dsr_id):
-                continue
-            for a in m.activities:
-                if isinstance(a, discord.Streaming) and a.platform == "Twitch":
-                    if (not filtered) or len(cats) == 0 or a.game in cats:
-                        if not a.twitch_name:
-                            continue
-                        is_live = True
-                        lower_name = a.twitch_name.casefold()
-                        thumb = None
-                        profile_image = None
-                        if lower_name in global_live_infos:
-                            global_info = global_live_infos[lower_name]
-                            thumb = global_info.thumbnail_url
-                            profile_image = global_info.profile_image_url
-                        global_live_infos[lower_name] = GlobalLiveInfo(
-                            game_name=a.game,
-                            title=a.name,
-                            url=a.url,
-                            thumbnail_url=thumb,
-                            profile_image_url=profile_image,
-                            started_at=a.created_at,
-                            game_image_url=a.game and global_game_images.get(a.game),
-                            from_twitch_api=global_live_infos[lower_name].from_twitch_api if lower_name in global_live_infos else False,
-                        )
-                        server_live_infos[lower_name] = ServerLiveInfo(
-                            display_name=m.display_name,
-                            display_avatar=m.display_avatar,
-                            has_streamer_role=True,
-                        )
-                    break
+        if not g in server_live_member_namess:
+            server_live_member_namess[g] = {}
+        live_member_names = server_live_member_namess[g]
+        candidates = server_streamer_candidatess.get(g)
+        if candidates is None:
+            # Dropped by a config command since presence_irrelevant built it
+            candidates = build_streamer_candidates(g, view, guild)
+        filtered = candidates.get(m.id)
+        a = None if filtered is None else member_twitch_stream(m, filtered, cats)
+        is_live = a is not None
+        if a:
+            lower_name = record_discord_stream(g, m, a)
+        else:
+            # The login they were live on before, if they were
+            lower_name = live_member_names.pop(m.id, None)
         if is_live:
             if dlr_id and dlr_id != 0:
-                try:
-                    if not m.get_role(dlr_id):
-                        dlr = guild.get_role(dlr_id)
-                        if dlr:
-                            if lower_name:
-                                server_live_members[lower_name] = m
-                            await m.add_roles(dlr, reason="Streaming Live")
-                except discord.Forbidden as e:
-                    print("MatoStreamshow needs permission to manage the live role in:")
-                    print("  Server name: " + d["name"])
-                    print("  Role id: " + str(dlr_id), flush=True)
-                    traceback.print_exception(e)
+                if not m.get_role(dlr_id):
+                    if guild.get_role(dlr_id):
+                        if lower_name:
+                            server_live_members[lower_name] = m.id
+                        add_live_role(d, guild.id, m.id, dlr_id)
             await ensure_message(g, lower_name)
         elif lower_name in global_live_infos and not global_live_infos[lower_name].from_twitch_api:
             print("on_presence_update: not is_live, in, not from_twitch_api")
             if dlr_id and dlr_id != 0:
-                try:
-                    dlr = m.get_role(dlr_id)
-                    if dlr:
-                        server_live_members.pop(lower_name, None)
-                        await m.remove_roles(dlr, reason="Not Streaming Live")
-                except discord.Forbidden as e:
-                    print("MatoStreamshow needs permission to manage the live role in:")
-                    print("  Server name: " + d["name"])
-                    print("  Role id: " + str(dlr_id), flush=True)
-                    traceback.print_exception(e)
-            server_live_infos.pop(lower_name, None)
-            any_left = False
-            for server_infos in server_live_infoss:
-                if lower_name in server_infos:
-                    any_left = True
-                    break
-            if not any_left:
-                global_live_infos.pop(lower_name, None)
+                if m.get_role(dlr_id):
+                    server_live_members.pop(lower_name, None)
+                    remove_live_role(d, guild.id, m.id, dlr_id)
+            # Drops the global entry too, if no other guild shows it
+            pop_server_live_info(g, lower_name)
             if not g in server_channel_msgss:
                 server_channel_msgss[g] = {}
             server_channel_msgs = server_channel_msgss[g]
-            msg = server_channel_msgs.pop(lower_name)
+            cancel_post(g, lower_name)
+            msg = server_channel_msgs.pop(lower_name, None)
             if msg:
                 print("on_presence_update: msg delete")
-                await msg.delete()
+                delete_message(d, msg)
             else:
                 print("on_presence_update: not msg")
 
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        if before.roles == after.roles:
+            return
+        g = str(after.guild.id)
+        candidates = server_streamer_candidatess.get(g)
+        if candidates is None:
+            # Not built yet, the next TwitchListen will build it with the new roles
+            return
+        filtered = streamer_candidate_filter(save.get_guild_view(g), after)
+        if filtered is None:
+            candidates.pop(after.id, None)
+        else:
+            candidates[after.id] = filtered
+        await self.on_presence_update(before, after)
+
+    async def on_member_remove(self, m: discord.Member):
+        g = str(m.guild.id)
+        server_streamer_candidatess.get(g, {}).pop(m.id, None)
+        lower_name = server_live_member_namess.get(g, {}).pop(m.id, None)
+        if lower_name:
+            server_live_memberss.get(g, {}).pop(lower_name, None)
+
+def stream_login(stream) -> str:
+    """
+    The casefolded login a stream is watched as, by its user id,
+    which is the old login until a rename is picked up by RefreshTwitchUsers.
+    """
+    return save.user_logins.get(stream.user_id) or stream.user_name.casefold()
+
+def merge_twitch_streams(batch: tuple[str, ...], streams: list, global_valid_keys: set[str]):
+    """
+    Updates global_live_infos from the live streams found for one batch of names,
+    and drops the names in the batch that weren't live.
+    Names already in global_valid_keys keep their info from Discord.
+    """
+    global thumbnail_url_template
+    global global_live_infos
+    for stream in streams:
+        thumb = stream.thumbnail_url.replace("{width}", "320").replace("{height}", "180")
+        if not thumbnail_url_template:
+            template = guess_thumbnail_url_template(stream.user_name, thumb)
+            if template and (not template in invalid_thumbnail_url_templates):
+                thumbnail_url_template = template
+                print("current thumbnail_url_template: " + thumbnail_url_template, flush=True)
+        elif guess_thumbnail_url(stream.user_name, thumbnail_url_template) != thumb:
+            print("invalid thumbnail_url_template: " + thumbnail_url_template, flush=True)
+            invalid_thumbnail_url_templates.append(thumbnail_url_template)
+            thumbnail_url_template = None
+        url = "https://www.twitch.tv/" + stream.user_name
+        lower_name = stream_login(stream)
+        if not poller_client:
+            # The poller process keeps the history when there is one
+            schedule.poll_schedule.record_live(lower_name)
+        if not lower_name in global_valid_keys:
+            global_live_infos[lower_name] = GlobalLiveInfo(
+                game_id=stream.game_id or None,
+                game_name=intern(stream.game_name),
+                title=intern(stream.title),
+                url=url,
+                thumbnail_url=thumb,
+                profile_image_url=global_live_infos[lower_name].profile_image_url if lower_name in global_live_infos else None,
+                started_at=stream.started_at,
+                game_image_url=stream.game_name and global_game_images.get(stream.game_name),
+                from_twitch_api=True,
+            )
+            hold_live(lower_name, TWITCH)
+            global_valid_keys.add(lower_name)
+    for lower_name in batch:
+        if not lower_name in global_valid_keys:
+            release_twitch_stream(lower_name)
+
+def fan_out_stream(lower_name: str, server_valid_keyss: dict[str, set[str]]):
+    """
+    Shows a live stream in only the guilds that watch it,
+    and whose category filter it passes.
+    """
+    global server_live_infoss
+    stream = global_live_infos.get(lower_name)
+    if stream is None:
+        return
+    for g, cap_name in save.get_streamer_guilds(lower_name).items():
+        server_live_infos = server_live_infoss.get(g, {})
+        if not g in server_valid_keyss:
+            server_valid_keyss[g] = set()
+        server_valid_keys = server_valid_keyss[g]
+        if not lower_name in server_valid_keys:
+            cats = save.get_guild_view(g).categories
+            if len(cats) == 0 or (stream.game_name and stream.game_name.casefold() in cats):
+                if not lower_name in server_live_infos:
+                    set_server_live_info(g, lower_name, ServerLiveInfo(
+                        display_name=cap_name,
+                        display_avatar=None,
+                        has_streamer_role=False,
+                    ))
+                server_valid_keys.add(lower_name)
+            elif (lower_name in server_live_infos) and (not server_live_infos[lower_name].has_streamer_role):
+                pop_server_live_info(g, lower_name)
+
+async def refresh_twitch_logins(lower_names: set[str]) -> set[str]:
+    """
+    Polls just these names, and updates their messages in every guild that watches them.
+    Returns the names that were found live.
+    """
+    if not api:
+        return set()
+    return await show_twitch_streams(lower_names, await helix.gather_streams_by_id(api, lower_names, save.user_ids))
+
+async def show_twitch_streams(lower_names: set[str], batch_results: list) -> set[str]:
+    """
+    Merges the get_streams results for just these names,
+    and updates their messages in every guild that watches them.
+    Returns the names that were found live.
+    """
+    # Names that are live from a Discord activity keep that info, like in TwitchListen
+    global_valid_keys: set[str] = {n for n in lower_names if n in global_live_infos and not global_live_infos[n].from_twitch_api}
+    server_valid_keyss: dict[str, set[str]] = {}
+    found: set[str] = set()
+    for batch, streams in batch_results:
+        if isinstance(streams, BaseException):
+            print("Twitch API Error in show_twitch_streams", flush=True)
+            traceback.print_exception(streams)
+            continue
+        found.update((stream_login(stream) for stream in streams))
+        merge_twitch_streams(batch, streams, global_valid_keys)
+    for lower_name in global_valid_keys:
+        fan_out_stream(lower_name, server_valid_keyss)
+    await ensure_profile_image_urls()
+    await ensure_game_images()
+    for g, server_valid_keys in server_valid_keyss.items():
+        for lower_name in server_valid_keys:
+            await ensure_message(g, lower_name)
+    return found
+
+async def on_poller_update(online: dict[str, poller.PolledStream], offline: list[str]):
+    if online:
+        await show_twitch_streams(set(online.keys()), [(tuple(online.keys()), list(online.values()))])
+    for lower_name in offline:
+        await on_twitch_stream_offline(lower_name)
+
+async def on_twitch_stream_online(lower_name: str):
+    async def poll() -> bool:
+        return lower_name in await refresh_twitch_logins({lower_name})
+    await eventsub.poll_until_live(poll)
+
+async def on_twitch_stream_offline(lower_name: str):
+    global global_live_infos
+    global server_live_infoss
+    global_info = global_live_infos.get(lower_name)
+    if not (global_info and global_info.from_twitch_api):
+        return
+    for g in release_twitch_stream(lower_name):
+        remove_live_message(g, lower_name)
+
+def check_batch_errors(batch_results: list, where: str) -> bool:
+    """
+    Reports a Twitch API server error from any of the batches, returning False if there was one.
+    Other errors are raised.
+    """
+    ok = True
+    for _, result in batch_results:
+        if isinstance(result, twitchAPI.type.TwitchBackendException):
+            if ok:
+                print("Twitch API Server Error in " + where, flush=True)
+                traceback.print_exception(result)
+            ok = False
+        elif isinstance(result, BaseException):
+            raise result
+    return ok
+
 async def ensure_profile_image_urls() -> bool:
     global global_live_infos
     global server_live_infoss
-    avatar_unknowns = set()
-    for g in save.get_guild_ids():
+    avatar_unknowns: set[str] = set()
+    for g in save.get_owned_guild_ids():
         d = save.get_guild_data(g)
         dc_id = d["channel_id"]
         if not (dc_id and dc_id != 0):
@@ -528,60 +1184,201 @@ async def ensure_profile_image_urls() -> bool:
         if not g in server_live_infoss:
             server_live_infoss[g] = {}
         server_live_infos = server_live_infoss[g]
-        avatar_unknowns.update((u for u, i in server_live_infos.items() if i.display_avatar == None))
-    try:
-        if api:
-            for batch in itertools.batched(avatar_unknowns, 100):
-                users = api.get_users(logins=list(batch))
-                async for user in users:
-                    lower_name = user.login.casefold()
-                    global_info = global_live_infos[lower_name]
-                    global_live_infos[lower_name] = global_info._replace(profile_image_url=user.profile_image_url)
+        for lower_name, server_info in server_live_infos.items():
+            if server_info.display_avatar != None or lower_name in avatar_unknowns:
+                continue
+            global_info = global_live_infos.get(lower_name)
+            if global_info is None:
+                continue
+            url = global_profile_images.get(lower_name)
+            if url and global_info.profile_image_url != url:
+                global_live_infos[lower_name] = global_info._replace(profile_image_url=url)
+            if not global_profile_images.is_fresh(lower_name):
+                avatar_unknowns.add(lower_name)
+    if not (api and avatar_unknowns):
         return True
-    except twitchAPI.type.TwitchBackendException as e:
-        print("Twitch API Server Error in TwitchListen", flush=True)
-        traceback.print_exception(e)
-        return False
+    batch_results = await helix.gather_batches(helix.get_users, api, avatar_unknowns)
+    for _, users in batch_results:
+        if isinstance(users, BaseException):
+            continue
+        for user in users:
+            lower_name = user.login.casefold()
+            global_profile_images[lower_name] = user.profile_image_url
+            global_info = global_live_infos.get(lower_name)
+            if global_info:
+                global_live_infos[lower_name] = global_info._replace(profile_image_url=user.profile_image_url)
+    return check_batch_errors(batch_results, "ensure_profile_image_urls")
 
 async def ensure_game_images() -> bool:
+    """
+    Fetches box art for the games being played, by game id when the Twitch API gave one,
+    and by name otherwise. Names that Twitch doesn't find are retried with backoff.
+    """
     global global_live_infos
     global global_game_images
-    game_image_unknowns: set[str] = set()
+    # Casefolded game name -> the name and game id to look it up by
+    game_image_unknowns: dict[str, tuple[str, str | None]] = {}
     for global_info in global_live_infos.values():
         if not isinstance(global_info.game_name, str):
             continue
-        elif global_info.game_name in global_game_images:
-            game_image_unknowns.discard(global_info.game_name)
-        elif global_info.game_name in game_image_unknowns:
+        key = global_info.game_name.casefold()
+        if key in game_image_unknowns:
+            if global_info.game_id:
+                game_image_unknowns[key] = (global_info.game_name, global_info.game_id)
+        elif global_game_images.is_fresh(key):
             continue
-        elif global_info.game_image_url:
-            global_game_images[global_info.game_name] = global_info.game_image_url
-            game_image_unknowns.discard(global_info.game_name)
-        else:
-            game_image_unknowns.add(global_info.game_name)
-    try:
-        if api:
-            for batch in itertools.batched(game_image_unknowns, 100):
-                games = api.get_games(names=list(batch))
-                async for game in games:
-                    global_game_images[game.name] = game.box_art_url.replace("{width}", "60").replace("{height}", "80")
+        elif global_info.game_image_url and not key in global_game_images:
+            global_game_images[key] = global_info.game_image_url
+        elif imagecache.game_misses.should_try(key):
+            game_image_unknowns[key] = (global_info.game_name, global_info.game_id)
+    if not (api and game_image_unknowns):
         return True
-    except twitchAPI.type.TwitchBackendException as e:
-        print("Twitch API Server Error in ensure_game_images", flush=True)
+    keys_by_id = {game_id: key for key, (_, game_id) in game_image_unknowns.items() if game_id}
+    names = [name for name, game_id in game_image_unknowns.values() if not game_id]
+    id_results, name_results = await asyncio.gather(
+        helix.gather_batches(helix.get_games_by_id, api, keys_by_id.keys()),
+        helix.gather_batches(helix.get_games, api, names),
+    )
+    for batch_results, key_of in ((id_results, keys_by_id.__getitem__), (name_results, str.casefold)):
+        for batch, games in batch_results:
+            if isinstance(games, BaseException):
+                continue
+            found: set[str] = set()
+            for game in games:
+                found.add(game.name.casefold())
+                global_game_images[game.name] = game.box_art_url.replace("{width}", "60").replace("{height}", "80")
+            for requested in batch:
+                key = key_of(requested)
+                if key in found:
+                    imagecache.game_misses.found(key)
+                else:
+                    imagecache.game_misses.missed(key)
+    return check_batch_errors(id_results + name_results, "ensure_game_images")
+
+# ---------------------------------------------------------
+
+# Discord writes, queued through writes.scheduler
+
+# Guild id and streamer name pairs with a live message queued or being sent
+posting: set[tuple[str, str]] = set()
+
+def report_forbidden(what: str, d: dict, id_label: str, id: int) -> Callable[[BaseException], None]:
+    def on_error(e: BaseException):
+        if isinstance(e, discord.Forbidden):
+            print("MatoStreamshow needs permission to " + what + " in:")
+            print("  Server name: " + d["name"])
+            print("  " + id_label + ": " + str(id), flush=True)
+        else:
+            print("Error in Discord write for server name: " + d["name"], flush=True)
         traceback.print_exception(e)
-        return False
+    return on_error
+
+def add_live_role(d: dict, guild_id: int, member_id: int, dlr_id: int):
+    writes.scheduler.submit(
+        writes.POST,
+        ("roles", guild_id),
+        lambda: bot.http.add_role(guild_id, member_id, dlr_id, reason="Streaming Live"),
+        on_error=report_forbidden("manage the live role", d, "Role id", dlr_id),
+    )
+
+def remove_live_role(d: dict, guild_id: int, member_id: int, dlr_id: int):
+    writes.scheduler.submit(
+        writes.CLEANUP,
+        ("roles", guild_id),
+        lambda: bot.http.remove_role(guild_id, member_id, dlr_id, reason="Not Streaming Live"),
+        on_error=report_forbidden("manage the live role", d, "Role id", dlr_id),
+    )
+
+def remove_live_message(g: str, name: str):
+    """
+    Deletes a streamer's live message in a guild, and takes away the live role it gave them.
+    """
+    d = save.get_guild_data(g)
+    cancel_post(g, name)
+    m = server_channel_msgss.get(g, {}).pop(name, None)
+    if m:
+        delete_message(d, m)
+    server_live_members = server_live_memberss.get(g, {})
+    if name in server_live_members:
+        guild = bot.get_guild(int(g))
+        dlr_id = d["live_role_id"]
+        if dlr_id and dlr_id != 0:
+            if guild and guild.get_role(dlr_id):
+                remove_live_role(d, guild.id, server_live_members.pop(name), dlr_id)
+
+def cancel_post(g: str, name: str):
+    """
+    Drops a live message that's still queued to be posted, such as for a streamer who has gone offline since.
+    One that's already being sent is deleted once it's known.
+    """
+    key = ("post", g, name)
+    if writes.scheduler.is_queued(key):
+        writes.scheduler.cancel(key)
+        posting.discard((g, name))
+
+def delete_message(d: dict, m: LiveMessage):
+    writes.scheduler.cancel(("edit", m.id))
+    writes.scheduler.submit(
+        writes.CLEANUP,
+        ("messages", m.channel_id),
+        m.partial().delete,
+        key=("delete", m.id),
+        on_error=report_forbidden("manage messages", d, "Channel id", m.channel_id),
+    )
+
+def edit_message(d: dict, g: str, name: str, m: LiveMessage, render: MessageRender):
+    report = report_forbidden("send messages", d, "Channel id", m.channel_id)
+    def on_error(e: BaseException):
+        if isinstance(e, discord.NotFound):
+            # Deleted without the bot seeing it, so the next update posts it again
+            server_channel_msgs = server_channel_msgss.get(g, {})
+            if name in server_channel_msgs and server_channel_msgs[name].id == m.id:
+                server_channel_msgs.pop(name, None)
+            return
+        # Forget what was sent, so the next update tries again
+        m.render = None
+        report(e)
+    # Queued edits to the same message are coalesced into this latest one
+    writes.scheduler.submit(
+        writes.EDIT,
+        ("messages", m.channel_id),
+        lambda: m.partial().edit(content=render.content, embed=render_embed(render)),
+        key=("edit", m.id),
+        on_error=on_error,
+    )
+    m.render = render
+
+def post_message(d: dict, g: str, name: str, dc: discord.TextChannel, render: MessageRender):
+    key = ("post", g, name)
+    if (g, name) in posting and not writes.scheduler.is_queued(key):
+        # Already being sent, a later update will edit it
+        return
+    posting.add((g, name))
+    async def post():
+        try:
+            m = await dc.send(render.content, embed=render_embed(render))
+        finally:
+            posting.discard((g, name))
+        if not g in server_channel_msgss:
+            server_channel_msgss[g] = {}
+        server_channel_msgss[g][name] = LiveMessage(m.id, dc.id, render)
+        return m
+    # A post still in the queue is coalesced into this latest one
+    writes.scheduler.submit(
+        writes.POST,
+        ("messages", dc.id),
+        post,
+        key=key,
+        on_error=report_forbidden("send messages", d, "Channel id", dc.id),
+    )
 
 async def ensure_message(g, name):
-    global thumbnail_url_template
-    global global_live_infos
-    global global_game_images
     global server_live_infoss
     global server_channel_msgss
     d = save.get_guild_data(g)
     dc_id = d["channel_id"]
     if not (dc_id and dc_id != 0):
         return
-    cap_l = d["twitch_streamer_list"]
     if not g in server_live_infoss:
         server_live_infoss[g] = {}
     server_live_infos = server_live_infoss[g]
@@ -592,37 +1389,84 @@ async def ensure_message(g, name):
         server_channel_msgss[g] = {}
     server_channel_msgs = server_channel_msgss[g]
     # -----------------------------------------------------
-    cap_name = recover_case(name, cap_l)
-    if not name in global_live_infos:
+    render = render_message(name, save.get_streamer_guilds(name).get(g, name), server_live_infos.get(name))
+    if not render:
         return
-    global_info = global_live_infos[name]
-    if not name in server_live_infos:
-        return
-    server_info = server_live_infos[name]
-    plain_game = plain(global_info.game_name) if global_info.game_name else ""
-    text = "**" + plain(server_info.display_name) + "** is live!" + ((" Playing " + plain_game) if global_info.game_name else "")
-    title = plain(global_info.title)
-    thumb = global_info.thumbnail_url or guess_thumbnail_url(name, thumbnail_url_template)
-    icon = server_info.display_avatar or global_info.profile_image_url
-    game_icon = global_info.game_image_url or global_game_images.get(global_info.game_name)
     if name in server_channel_msgs:
         m = server_channel_msgs[name]
-        if m.content != text or len(m.embeds) == 0 or m.embeds[0].title != title:
-            embed = discord.Embed(colour=discord.Colour.purple(), title=title, url=global_info.url)
-            embed.set_author(name=cap_name, url=global_info.url, icon_url=icon)
-            embed.set_thumbnail(url=thumb)
-            embed.set_footer(text=plain_game, icon_url=game_icon)
-            if global_info.started_at:
-                embed.timestamp = global_info.started_at
-            server_channel_msgs[name] = await m.edit(content=text, embed=embed)
+        if m.render != render:
+            edit_message(d, g, name, m, render)
     else:
-        embed = discord.Embed(colour=discord.Colour.purple(), title=title, url=global_info.url)
-        embed.set_author(name=cap_name, url=global_info.url, icon_url=icon)
-        embed.set_thumbnail(url=thumb)
-        embed.set_footer(text=plain_game, icon_url=game_icon)
-        if global_info.started_at:
-            embed.timestamp = global_info.started_at
-        server_channel_msgs[name] = await dc.send(text, embed=embed)
+        post_message(d, g, name, dc, render)
+
+# ---------------------------------------------------------
+
+# Live state snapshot, for warm restarts
+
+LIVE_STATE_PATH = "live_state.json"
+# A snapshot older than this is ignored, since too much will have changed
+LIVE_STATE_MAX_AGE = 60 * 60
+
+live_state_backend = storage.JsonStorage(LIVE_STATE_PATH)
+
+def tuple_to_json(t: tuple) -> dict:
+    return {k: v.isoformat() if isinstance(v, datetime.datetime) else v for k, v in t._asdict().items()}
+
+def tuple_of_json(cls, j: dict):
+    return cls(**{k: datetime.datetime.fromisoformat(j[k]) if k in ("started_at", "timestamp") and j.get(k) else j.get(k) for k in cls._fields})
+
+def live_state_snapshot() -> dict:
+    """
+    What's live, which messages show it, and who has the live role,
+    without any discord.py objects.
+    """
+    return {
+        "saved_at": time.time(),
+        "global_live_infos": {n: tuple_to_json(i) for n, i in global_live_infos.items()},
+        "server_live_infoss": {g: {n: tuple_to_json(i) for n, i in infos.items()} for g, infos in server_live_infoss.items()},
+        "server_channel_msgss": {g: {n: [m.id, m.channel_id, m.render and tuple_to_json(m.render)] for n, m in msgs.items()} for g, msgs in server_channel_msgss.items()},
+        "server_channel_seeded": dict(server_channel_seeded),
+        "server_live_memberss": {g: dict(members) for g, members in server_live_memberss.items()},
+        "server_live_member_namess": {g: {str(i): n for i, n in names.items()} for g, names in server_live_member_namess.items()},
+    }
+
+async def write_live_state():
+    try:
+        await asyncio.to_thread(live_state_backend.write, live_state_snapshot())
+    except Exception as e:
+        print("Could not write " + LIVE_STATE_PATH, flush=True)
+        traceback.print_exception(e)
+
+def load_live_state() -> bool:
+    """
+    Picks up where the last run left off, if it wrote a snapshot recently enough.
+    The first ticks then reconcile it, polling Twitch and checking presences as usual,
+    and only edit, delete or post again the messages that changed while the bot was down.
+    Channel history isn't read again until the next rescan.
+    """
+    try:
+        j = live_state_backend.load()
+    except Exception as e:
+        print("Could not read " + LIVE_STATE_PATH + ", starting without it", flush=True)
+        traceback.print_exception(e)
+        return False
+    if not j or LIVE_STATE_MAX_AGE < time.time() - j.get("saved_at", 0):
+        return False
+    for n, i in j["global_live_infos"].items():
+        info = tuple_of_json(GlobalLiveInfo, i)
+        global_live_infos[n] = info._replace(game_name=intern(info.game_name), title=intern(info.title))
+    for g, infos in j["server_live_infoss"].items():
+        server_live_infoss[g] = {n: tuple_of_json(ServerLiveInfo, i) for n, i in infos.items()}
+    rebuild_live_holders()
+    for g, msgs in j["server_channel_msgss"].items():
+        server_channel_msgss[g] = {n: LiveMessage(id, channel_id, render and tuple_of_json(MessageRender, render)) for n, (id, channel_id, render) in msgs.items()}
+    server_channel_seeded.update(j["server_channel_seeded"])
+    for g, members in j["server_live_memberss"].items():
+        server_live_memberss[g] = dict(members)
+    for g, names in j["server_live_member_namess"].items():
+        server_live_member_namess[g] = {int(i): n for i, n in names.items()}
+    print("Loaded the live state from " + LIVE_STATE_PATH, flush=True)
+    return True
 
 # ---------------------------------------------------------
 
@@ -637,6 +1481,8 @@ bot = MatoStreamshow(intents=intents)
 async def on_ready():
     if not bot.TwitchListen.is_running():
         bot.TwitchListen.start()
+    if not bot.RefreshTwitchUsers.is_running():
+        bot.RefreshTwitchUsers.start()
     print('MatoStreamshow Bot is online!', flush=True)
 
 @bot.tree.command()
@@ -653,6 +1499,21 @@ async def ping(interaction: discord.Interaction):
     save.get_guild_data(str(interaction.guild.id))["name"] = interaction.guild.name
     await interaction.response.send_message("Pong!")
 
+@bot.tree.command()
+async def stats(interaction: discord.Interaction):
+    """
+    Shows where the bot's time goes, and how many API calls it makes. Only for the bot's owner.
+
+    Parameters
+    ----------
+    interaction : discord.Interaction
+        The interaction object.
+    """
+    if not await is_owner(interaction.user):
+        await interaction.response.send_message("Only the bot's owner can see its stats", ephemeral=True)
+        return
+    await interaction.response.send_message(codeblock(metrics.format_stats()), ephemeral=True)
+
 @bot.tree.command()
 @app_commands.default_permissions(manage_channels=True)
 @app_commands.checks.has_permissions(manage_channels=True)
@@ -672,11 +1533,15 @@ async def channel(interaction: discord.Interaction, channel: discord.TextChannel
     d["name"] = interaction.guild.name
     if channel.permissions_for(interaction.guild.me).send_messages:
         d["channel_id"] = channel.id
-        save.save()
+        save.index_guild(str(interaction.guild.id))
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
         await interaction.response.send_message("Posting stream live messages in " + channel.mention)
     elif d["channel_id"] == 0:
         d["channel_id"] = channel.id
-        save.save()
+        save.index_guild(str(interaction.guild.id))
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
         await interaction.response.send_message("Warning: MatoStreamshow needs permission to send messages in " + channel.mention)
     else:
         await interaction.response.send_message("Error: MatoStreamshow needs permission to send messages in " + channel.mention)
@@ -696,8 +1561,6 @@ async def streamer_role_list(interaction: discord.Interaction):
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "streamer_roles" in d:
-        d["streamer_roles"] = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
     streamer_roles = d["streamer_roles"]
     role_list: list[str] = []
     for k in set(streamer_roles.keys()):
@@ -707,7 +1570,7 @@ async def streamer_role_list(interaction: discord.Interaction):
         else:
             streamer_roles.pop(k, None)
     role_list.sort(key=str.casefold)
-    save.save()
+    save.save(str(interaction.guild.id))
     await interaction.response.send_message(codeblock(repr(role_list), language="python"))
 
 @bot.tree.command(name="streamer-role-add")
@@ -729,11 +1592,10 @@ async def streamer_role_add(interaction: discord.Interaction, role: discord.Role
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "streamer_roles" in d:
-        d["streamer_roles"] = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
     streamer_roles = d["streamer_roles"]
     streamer_roles[str(role.id)] = filtered
-    save.save()
+    server_streamer_candidatess.pop(str(interaction.guild.id), None)
+    save.save(str(interaction.guild.id))
     await interaction.response.send_message("Added streamer role " + plain(role.name))
 
 @bot.tree.command(name="streamer-role-remove")
@@ -753,14 +1615,12 @@ async def streamer_role_remove(interaction: discord.Interaction, role: discord.R
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "streamer_roles" in d:
-        await interaction.response.send_message(plain(role.name) + " not found")
-        return
     streamer_roles = d["streamer_roles"]
     s = str(role.id)
     if s in streamer_roles:
         streamer_roles.pop(s, None)
-        save.save()
+        server_streamer_candidatess.pop(str(interaction.guild.id), None)
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Removed streamer role " + plain(role.name))
     else:
         await interaction.response.send_message(plain(role.name) + " not found")
@@ -786,7 +1646,8 @@ async def streamer_role(interaction: discord.Interaction, role: discord.Role, fi
     d["name"] = interaction.guild.name
     d["streamer_role_id"] = role.id
     d["streamer_roles"] = { str(role.id): filtered }
-    save.save()
+    server_streamer_candidatess.pop(str(interaction.guild.id), None)
+    save.save(str(interaction.guild.id))
     await interaction.response.send_message("Streamer role set to " + plain(role.name))
 
 @bot.tree.command(name="muted-role-list")
@@ -804,11 +1665,9 @@ async def muted_role_list(interaction: discord.Interaction):
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "muted_role_list" in d:
-        d["muted_role_list"] = []
     muted_role_list = d["muted_role_list"]
     muted_role_list.sort()
-    save.save()
+    save.save(str(interaction.guild.id))
     await interaction.response.send_message(codeblock(repr(muted_role_list), language="python"))
 
 @bot.tree.command(name="muted-role-add")
@@ -828,15 +1687,14 @@ async def muted_role_add(interaction: discord.Interaction, role: discord.Role):
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "muted_role_list" in d:
-        d["muted_role_list"] = []
     muted_role_list = d["muted_role_list"]
     if role.id in muted_role_list:
         await interaction.response.send_message("Already muted role " + plain(role.name))
     else:
         muted_role_list.append(role.id)
+        server_streamer_candidatess.pop(str(interaction.guild.id), None)
         muted_role_list.sort()
-        save.save()
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Added muted role " + plain(role.name))
 
 @bot.tree.command(name="muted-role-remove")
@@ -856,13 +1714,11 @@ async def muted_role_remove(interaction: discord.Interaction, role: discord.Role
     if interaction.guild is None: return
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
-    if not "muted_role_list" in d:
-        await interaction.response.send_message(plain(role.name) + " not found")
-        return
     muted_role_list = d["muted_role_list"]
     if role.id in muted_role_list:
         muted_role_list.remove(role.id)
-        save.save()
+        server_streamer_candidatess.pop(str(interaction.guild.id), None)
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Removed muted role " + plain(role.name))
     else:
         await interaction.response.send_message(plain(role.name) + " not found")
@@ -886,11 +1742,11 @@ async def live_role(interaction: discord.Interaction, role: discord.Role):
     d["name"] = interaction.guild.name
     if role.is_assignable():
         d["live_role_id"] = role.id
-        save.save()
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Live role set to " + plain(role.name))
     elif d["live_role_id"] == 0:
         d["live_role_id"] = role.id
-        save.save()
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Warning: MatoStreamshow can't assign "+ plain(role.name) + " until MatoStreamshow's role is moved above it")
     else:
         await interaction.response.send_message("Error: MatoStreamshow can't assign "+ plain(role.name) + " unless MatoStreamshow's role is moved above it")
@@ -911,8 +1767,11 @@ async def twitch_streamer_list(interaction: discord.Interaction):
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
     cap_l = d["twitch_streamer_list"]
-    save.save()
-    await interaction.response.send_message(codeblock(repr(cap_l), language="python"))
+    invalid = [s for s in cap_l if users.is_invalid(s.casefold())]
+    if invalid:
+        await interaction.response.send_message(codeblock(repr(cap_l), language="python") + "Not found on Twitch: " + plain(", ".join(invalid)))
+    else:
+        await interaction.response.send_message(codeblock(repr(cap_l), language="python"))
 
 @bot.tree.command(name="twitch-streamer-add")
 @app_commands.default_permissions(manage_roles=True)
@@ -935,14 +1794,30 @@ async def twitch_streamer_add(interaction: discord.Interaction, twitch_username:
     tu = parse_twitch_username(twitch_username)
     if tu == None:
         await interaction.response.send_message(code(repr(twitch_username)) + " is not a valid twitch username")
-    elif tu.casefold() in (s.casefold() for s in twitch_streamer_list):
+    elif tu.casefold() in save.get_guild_view(str(interaction.guild.id)).streamers:
         await interaction.response.send_message("Already contains " + plain(recover_case(tu, twitch_streamer_list)))
     elif 100 <= len(twitch_streamer_list):
         await interaction.response.send_message("You can only specify up to 100 names (Twitch API constraint)")
     else:
+        user = None
+        if api:
+            try:
+                # Leave time to reply, if this doesn't finish in time it's resolved before the next poll
+                user = await asyncio.wait_for(users.lookup(api, tu.casefold()), 2)
+                if user is None:
+                    await interaction.response.send_message("Twitch user " + plain(tu) + " not found")
+                    return
+            except Exception as e:
+                print("Could not look up Twitch user: " + tu, flush=True)
+                traceback.print_exception(e)
+        if user:
+            tu = users.canonical_name(user)
+            d["twitch_user_ids"][tu.casefold()] = user.id
         twitch_streamer_list.append(tu)
         twitch_streamer_list.sort(key=str.casefold)
-        save.save()
+        save.index_streamer(str(interaction.guild.id), tu)
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
         await interaction.response.send_message("Added twitch user " + plain(tu))
 
 @bot.tree.command(name="twitch-streamer-remove")
@@ -963,16 +1838,106 @@ async def twitch_streamer_remove(interaction: discord.Interaction, twitch_userna
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
     cap_l = d["twitch_streamer_list"]
+    streamers = save.get_guild_view(str(interaction.guild.id)).streamers
     tu = parse_twitch_username(twitch_username)
     if tu == None:
         await interaction.response.send_message(code(repr(twitch_username)) + " is not a valid twitch username")
-    elif tu in cap_l:
+    elif tu.casefold() in streamers:
+        # As written in the list, which can differ in case after it's looked up on Twitch
+        tu = streamers[tu.casefold()]
         cap_l.remove(tu)
-        save.save()
+        d["twitch_user_ids"].pop(tu.casefold(), None)
+        if tu.casefold() in (s.casefold() for s in d["priority_streamer_list"]):
+            d["priority_streamer_list"].remove(recover_case(tu, d["priority_streamer_list"]))
+        save.unindex_streamer(str(interaction.guild.id), tu)
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
         await interaction.response.send_message("Removed twitch user " + plain(tu))
     else:
         await interaction.response.send_message(plain(tu) + " not found")
 
+@bot.tree.command(name="priority-streamer-list")
+@app_commands.default_permissions(manage_roles=True)
+@app_commands.checks.has_permissions(manage_roles=True)
+async def priority_streamer_list(interaction: discord.Interaction):
+    """
+    Lists the twitch streamers to check every minute, however rarely they stream.
+
+    Parameters
+    ----------
+    interaction : discord.Interaction
+        The interaction object.
+    """
+    if interaction.guild is None: return
+    d = save.get_guild_data(str(interaction.guild.id))
+    d["name"] = interaction.guild.name
+    cap_l = d["priority_streamer_list"]
+    await interaction.response.send_message(codeblock(repr(cap_l), language="python"))
+
+@bot.tree.command(name="priority-streamer-add")
+@app_commands.default_permissions(manage_roles=True)
+@app_commands.checks.has_permissions(manage_roles=True)
+async def priority_streamer_add(interaction: discord.Interaction, twitch_username: str):
+    """
+    Checks a twitch streamer every minute, however rarely they stream.
+
+    Parameters
+    ----------
+    interaction : discord.Interaction
+        The interaction object.
+    twitch_username : str
+        The streamer's twitch username, which must already be added with `/twitch-streamer-add`.
+    """
+    if interaction.guild is None: return
+    d = save.get_guild_data(str(interaction.guild.id))
+    d["name"] = interaction.guild.name
+    priority_streamer_list = d["priority_streamer_list"]
+    twitch_streamer_list = d["twitch_streamer_list"]
+    tu = parse_twitch_username(twitch_username)
+    if tu == None:
+        await interaction.response.send_message(code(repr(twitch_username)) + " is not a valid twitch username")
+    elif not tu.casefold() in (s.casefold() for s in twitch_streamer_list):
+        await interaction.response.send_message(plain(tu) + " not found, add them with `/twitch-streamer-add` first")
+    elif tu.casefold() in (s.casefold() for s in priority_streamer_list):
+        await interaction.response.send_message("Already contains " + plain(recover_case(tu, priority_streamer_list)))
+    else:
+        tu = recover_case(tu, twitch_streamer_list)
+        priority_streamer_list.append(tu)
+        priority_streamer_list.sort(key=str.casefold)
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
+        await interaction.response.send_message("Added priority twitch user " + plain(tu))
+
+@bot.tree.command(name="priority-streamer-remove")
+@app_commands.default_permissions(manage_roles=True)
+@app_commands.checks.has_permissions(manage_roles=True)
+async def priority_streamer_remove(interaction: discord.Interaction, twitch_username: str):
+    """
+    Goes back to checking a twitch streamer as often as they usually stream.
+
+    Parameters
+    ----------
+    interaction : discord.Interaction
+        The interaction object.
+    twitch_username : str
+        The streamer's twitch username.
+    """
+    if interaction.guild is None: return
+    d = save.get_guild_data(str(interaction.guild.id))
+    d["name"] = interaction.guild.name
+    cap_l = d["priority_streamer_list"]
+    tu = parse_twitch_username(twitch_username)
+    if tu == None:
+        await interaction.response.send_message(code(repr(twitch_username)) + " is not a valid twitch username")
+    elif tu.casefold() in (s.casefold() for s in cap_l):
+        tu = recover_case(tu, cap_l)
+        cap_l.remove(tu)
+        save.save(str(interaction.guild.id))
+        bot.sync_stream_events()
+        await interaction.response.send_message("Removed priority twitch user " + plain(tu))
+    else:
+        await interaction.response.send_message(plain(tu) + " not found")
+
 @bot.tree.command(name="twitch-category-list")
 @app_commands.default_permissions(manage_roles=True)
 @app_commands.checks.has_permissions(manage_roles=True)
@@ -989,7 +1954,6 @@ async def twitch_category_list(interaction: discord.Interaction):
     d = save.get_guild_data(str(interaction.guild.id))
     d["name"] = interaction.guild.name
     cap_l = d["twitch_category_list"]
-    save.save()
     await interaction.response.send_message(codeblock(repr(cap_l), language="python"))
 
 @bot.tree.command(name="twitch-category-add")
@@ -1030,7 +1994,7 @@ async def twitch_category_add(interaction: discord.Interaction, twitch_category:
         else:
             twitch_category_list.append(game_name)
             twitch_category_list.sort(key=str.casefold)
-            save.save()
+            save.save(str(interaction.guild.id))
             await interaction.response.send_message("Added category " + plain(game_name))
 
 @bot.tree.command(name="twitch-category-remove")
@@ -1053,11 +2017,18 @@ async def twitch_category_remove(interaction: discord.Interaction, twitch_catego
     cap_l = d["twitch_category_list"]
     if twitch_category in cap_l:
         cap_l.remove(twitch_category)
-        save.save()
+        save.save(str(interaction.guild.id))
         await interaction.response.send_message("Removed category " + plain(twitch_category))
     else:
         await interaction.response.send_message(plain(twitch_category) + " not found")
 
+async def is_owner(user: discord.User | discord.Member) -> bool:
+    # Cached at login, so /stats doesn't ask Discord every time
+    app_info = bot.application or await bot.application_info()
+    if app_info.team:
+        return any((m.id == user.id for m in app_info.team.members))
+    return app_info.owner.id == user.id
+
 def has_any_of_role_ids(m: discord.Member, role_ids: list[int]):
     for role_id in role_ids:
         if m.get_role(role_id):
@@ -1065,8 +2036,12 @@ def has_any_of_role_ids(m: discord.Member, role_ids: list[int]):
     return False
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force-sync", action="store_true", help="sync the commands with Discord even if they haven't changed")
+    args = parser.parse_args()
     if config.token == "":
         raise ValueError('config token not found')
+    bot.force_sync = args.force_sync
     bot.run(config.token)
 
 if __name__ == "__main__":
@@ -8,6 +8,34 @@ with open(JSON_PATH) as f:
 token: str = data["token"]
 twitch_api_id: str | None = data.get("twitch_api_id")
 twitch_api_secret: str | None = data.get("twitch_api_secret")
+twitch_concurrency: int = data.get("twitch_concurrency", 8)
+twitch_points_per_minute: int = data.get("twitch_points_per_minute", 800)
+discord_concurrency: int = data.get("discord_concurrency", 10)
+shard_count: int | None = data.get("shard_count")
+shard_ids: list[int] | None = data.get("shard_ids")
+history_rescan_ticks: int = data.get("history_rescan_ticks", 60)
+adaptive_polling: bool = data.get("adaptive_polling", True)
+member_audit_ticks: int = data.get("member_audit_ticks", 60)
+presence_coalesce_seconds: float = data.get("presence_coalesce_seconds", 5)
+live_state_ticks: int = data.get("live_state_ticks", 5)
+storage: str = data.get("storage", "json")
+sqlite_path: str = data.get("sqlite_path", "save.db")
+save_interval: float = data.get("save_interval", 5)
+image_cache_size: int = data.get("image_cache_size", 5000)
+image_cache_ttl_hours: float = data.get("image_cache_ttl_hours", 24)
+eventsub_mode: str | None = data.get("eventsub_mode")
+eventsub_callback_url: str | None = data.get("eventsub_callback_url")
+eventsub_port: int = data.get("eventsub_port", 8080)
+eventsub_secret: str | None = data.get("eventsub_secret")
+eventsub_connection_url: str | None = data.get("eventsub_connection_url")
+eventsub_subscription_url: str | None = data.get("eventsub_subscription_url")
+eventsub_reconcile_ticks: int = data.get("eventsub_reconcile_ticks", 10)
+poller_socket: str | None = data.get("poller_socket")
+metrics_port: int | None = data.get("metrics_port")
+metrics_host: str = data.get("metrics_host", "127.0.0.1")
+twitch_id_refresh_hours: float = data.get("twitch_id_refresh_hours", 24)
+twitch_user_token: str | None = data.get("twitch_user_token")
+twitch_user_refresh_token: str | None = data.get("twitch_user_refresh_token")
 
 """
 Example config.json:
@@ -0,0 +1,133 @@
+import asyncio, traceback
+from typing import Awaitable, Callable
+
+import config
+import helix
+from twitchAPI.eventsub.base import EventSubBase
+from twitchAPI.eventsub.webhook import EventSubWebhook
+from twitchAPI.eventsub.websocket import EventSubWebsocket
+from twitchAPI.object.eventsub import StreamOfflineEvent, StreamOnlineEvent
+from twitchAPI.twitch import Twitch
+
+# Seconds to wait before each poll after a stream.online event,
+# since the stream can take a little while to show up in get_streams after it
+ONLINE_POLL_DELAYS = (0, 5, 15, 30)
+
+async def poll_until_live(poll: Callable[[], Awaitable[bool]]) -> bool:
+    """
+    Calls poll after each of ONLINE_POLL_DELAYS until it returns that the stream was found live.
+    """
+    for delay in ONLINE_POLL_DELAYS:
+        await asyncio.sleep(delay)
+        if await poll():
+            return True
+    return False
+
+class StreamEvents:
+    """
+    Keeps stream.online and stream.offline subscriptions matching the watched streamers,
+    and calls on_online or on_offline with the casefolded login when one fires.
+
+    The transport is chosen by eventsub_mode in config.json,
+    either "webhook" or "websocket".
+    Both can be pointed at a local mock server, such as the one in the Twitch CLI,
+    with eventsub_subscription_url and eventsub_connection_url.
+    """
+
+    def __init__(self, api: Twitch, on_online: Callable[[str], Awaitable[None]], on_offline: Callable[[str], Awaitable[None]]):
+        self.api = api
+        self.on_online = on_online
+        self.on_offline = on_offline
+        self.eventsub: EventSubBase | None = None
+        # casefolded login -> user id
+        self.user_ids: dict[str, str] = {}
+        # casefolded login -> (stream.online subscription id, stream.offline subscription id)
+        self.subscriptions: dict[str, tuple[str, str]] = {}
+        self.lock = asyncio.Lock()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        if config.eventsub_mode == "webhook":
+            if not config.eventsub_callback_url:
+                raise ValueError("config eventsub_callback_url not found")
+            webhook = EventSubWebhook(config.eventsub_callback_url, config.eventsub_port, self.api, subscription_url=config.eventsub_subscription_url, callback_loop=loop)
+            if config.eventsub_secret:
+                webhook.secret = config.eventsub_secret
+            # Don't hold up subscribing thousands of streamers waiting for each confirmation
+            webhook.wait_for_subscription_confirm = False
+            self.eventsub = webhook
+        elif config.eventsub_mode == "websocket":
+            self.eventsub = EventSubWebsocket(self.api, connection_url=config.eventsub_connection_url, subscription_url=config.eventsub_subscription_url, callback_loop=loop)
+        else:
+            raise ValueError("config eventsub_mode must be \"webhook\" or \"websocket\", not " + repr(config.eventsub_mode))
+        # start blocks until the transport is up
+        await asyncio.to_thread(self.eventsub.start)
+        if isinstance(self.eventsub, EventSubWebhook) and config.shard_ids is None:
+            # Webhook subscriptions outlive the process, clear out the previous run's.
+            # Not when other processes run the other shards, since this would clear theirs too.
+            await self.eventsub.unsubscribe_all()
+
+    async def stop(self):
+        if self.eventsub:
+            await self.eventsub.stop()
+            self.eventsub = None
+        self.subscriptions.clear()
+
+    async def sync(self, lower_set: set[str], user_ids: dict[str, str] | None = None):
+        """
+        Subscribes to the names in lower_set that aren't subscribed yet,
+        and unsubscribes from the ones that aren't in it anymore.
+        user_ids are the ids already known, by casefolded login, the rest are looked up.
+        """
+        async with self.lock:
+            eventsub = self.eventsub
+            if not eventsub:
+                return
+            for lower_name in set(self.subscriptions.keys()) - lower_set:
+                for sub_id in self.subscriptions.pop(lower_name):
+                    try:
+                        await helix.limiter.acquire()
+                        await eventsub.unsubscribe_topic(sub_id)
+                    except Exception as e:
+                        print("Could not unsubscribe from EventSub for: " + lower_name, flush=True)
+                        traceback.print_exception(e)
+            added = lower_set - set(self.subscriptions.keys())
+            for lower_name in added:
+                if user_ids and lower_name in user_ids:
+                    self.user_ids[lower_name] = user_ids[lower_name]
+            unknown = [n for n in added if not n in self.user_ids]
+            for _, users in await helix.gather_batches(helix.get_users, self.api, unknown):
+                if isinstance(users, BaseException):
+                    print("Twitch API Error resolving users for EventSub", flush=True)
+                    traceback.print_exception(users)
+                    continue
+                for user in users:
+                    self.user_ids[user.login.casefold()] = user.id
+            for lower_name in added:
+                user_id = self.user_ids.get(lower_name)
+                if not user_id:
+                    # Not a real account, polling will keep finding it offline
+                    continue
+                try:
+                    await helix.limiter.acquire()
+                    online = await eventsub.listen_stream_online(user_id, self.handle_online)
+                    await helix.limiter.acquire()
+                    offline = await eventsub.listen_stream_offline(user_id, self.handle_offline)
+                    self.subscriptions[lower_name] = (online, offline)
+                except Exception as e:
+                    print("Could not subscribe to EventSub for: " + lower_name, flush=True)
+                    traceback.print_exception(e)
+
+    async def handle_online(self, event: StreamOnlineEvent):
+        try:
+            await self.on_online(event.event.broadcaster_user_login.casefold())
+        except Exception as e:
+            print("Error handling stream.online", flush=True)
+            traceback.print_exception(e)
+
+    async def handle_offline(self, event: StreamOfflineEvent):
+        try:
+            await self.on_offline(event.event.broadcaster_user_login.casefold())
+        except Exception as e:
+            print("Error handling stream.offline", flush=True)
+            traceback.print_exception(e)
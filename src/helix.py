@@ -0,0 +1,99 @@
+import asyncio, itertools, time
+
+import config
+import metrics
+import twitchAPI.object.api
+import twitchAPI.type
+from twitchAPI.twitch import Twitch
+
+# Helix gives an app access token a bucket of points that refills
+# continuously over a minute, and every request made here costs 1 point.
+# The twitchAPI library only waits once the bucket is already empty,
+# so concurrent batches are paced here before they are sent.
+
+class RateLimiter:
+    def __init__(self, points_per_minute: int):
+        self.capacity = max(1, points_per_minute)
+        self.rate = self.capacity / 60.0
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if 1 <= self.tokens:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+limiter = RateLimiter(config.twitch_points_per_minute)
+slots = asyncio.Semaphore(max(1, config.twitch_concurrency))
+
+async def get_streams_by_id(api: Twitch, batch: tuple[str, ...]) -> list[twitchAPI.object.api.Stream]:
+    async with slots:
+        await limiter.acquire()
+        metrics.count_twitch_call("get_streams")
+        streams = api.get_streams(stream_type="live", user_id=list(batch), first=100)
+        return [stream async for stream in streams]
+
+async def get_users(api: Twitch, batch: tuple[str, ...]) -> list[twitchAPI.object.api.TwitchUser]:
+    async with slots:
+        await limiter.acquire()
+        metrics.count_twitch_call("get_users")
+        users = api.get_users(logins=list(batch))
+        return [user async for user in users]
+
+async def get_users_by_id(api: Twitch, batch: tuple[str, ...]) -> list[twitchAPI.object.api.TwitchUser]:
+    async with slots:
+        await limiter.acquire()
+        metrics.count_twitch_call("get_users")
+        users = api.get_users(user_ids=list(batch))
+        return [user async for user in users]
+
+async def get_games(api: Twitch, batch: tuple[str, ...]) -> list[twitchAPI.object.api.Game]:
+    async with slots:
+        await limiter.acquire()
+        metrics.count_twitch_call("get_games")
+        games = api.get_games(names=list(batch))
+        return [game async for game in games]
+
+async def get_games_by_id(api: Twitch, batch: tuple[str, ...]) -> list[twitchAPI.object.api.Game]:
+    async with slots:
+        await limiter.acquire()
+        metrics.count_twitch_call("get_games")
+        games = api.get_games(game_ids=list(batch))
+        return [game async for game in games]
+
+async def gather_batches(fetch, api: Twitch, names) -> list[tuple[tuple[str, ...], list | BaseException]]:
+    """
+    Runs fetch on every batch of up to 100 names concurrently,
+    limited by twitch_concurrency and the Helix rate limit.
+    Returns each batch with either its results or the exception it raised,
+    so that one failed batch doesn't throw away the others.
+    """
+    batches = list(itertools.batched(names, 100))
+    results = await asyncio.gather(*(fetch(api, batch) for batch in batches), return_exceptions=True)
+    for result in results:
+        if isinstance(result, twitchAPI.type.TwitchBackendException):
+            # twitchAPI doesn't say which server error it was
+            metrics.count_http_error("twitch", "5xx")
+    return list(zip(batches, results))
+
+async def gather_streams_by_id(api: Twitch, lower_names, user_ids: dict[str, str]) -> list[tuple[tuple[str, ...], list | BaseException]]:
+    """
+    Polls the streams of lower_names by the user ids in user_ids, a dict from casefolded login to user id,
+    returning each batch as the logins it was for.
+    The logins without a user id aren't polled, they come back as one more batch with no streams,
+    since they aren't real accounts, or haven't been resolved yet.
+    """
+    logins = {user_ids[n]: n for n in lower_names if n in user_ids}
+    batch_results = await gather_batches(get_streams_by_id, api, logins.keys())
+    results = [(tuple((logins[user_id] for user_id in batch)), result) for batch, result in batch_results]
+    unresolved = tuple((n for n in lower_names if not n in user_ids))
+    if unresolved:
+        results.append((unresolved, []))
+    return results
@@ -0,0 +1,182 @@
+import asyncio, collections, sqlite3, time, traceback
+
+import config
+
+DB_PATH = "image_cache.db"
+
+class ImageCache:
+    """
+    Image URLs by key, in a small in-memory LRU in front of a table in DB_PATH,
+    so they survive restarts without all being loaded into memory.
+    Keys are matched case-insensitively.
+    Entries older than ttl seconds are still returned by get,
+    but is_fresh reports them as stale so they can be fetched again.
+    The keys in the table are loaded at startup, so looking up a key that isn't there
+    doesn't touch the database, and writes happen in a worker thread.
+    """
+
+    def __init__(self, db: sqlite3.Connection, table: str, capacity: int, ttl: float):
+        self.db = db
+        self.table = table
+        self.capacity = max(1, capacity)
+        self.ttl = ttl
+        self.memory: collections.OrderedDict[str, tuple[str, float]] = collections.OrderedDict()
+        # Writes waiting for the next flush, and the ones being written by it
+        self.pending: dict[str, tuple[str, float]] = {}
+        self.writing: dict[str, tuple[str, float]] = {}
+        db.execute("CREATE TABLE IF NOT EXISTS " + table + " (key TEXT PRIMARY KEY, url TEXT NOT NULL, fetched_at REAL NOT NULL)")
+        self.on_disk: set[str] = {row[0] for row in db.execute("SELECT key FROM " + table)}
+
+    def remember(self, key: str, entry: tuple[str, float]):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while self.capacity < len(self.memory):
+            self.memory.popitem(last=False)
+
+    def lookup(self, key: str) -> tuple[str, float] | None:
+        key = key.casefold()
+        entry = self.memory.get(key)
+        if entry is not None:
+            self.memory.move_to_end(key)
+            return entry
+        entry = self.pending.get(key) or self.writing.get(key)
+        if entry is None:
+            if not key in self.on_disk:
+                return None
+            row = self.db.execute("SELECT url, fetched_at FROM " + self.table + " WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            entry = (row[0], row[1])
+        self.remember(key, entry)
+        return entry
+
+    def get(self, key: str | None, default: str | None = None) -> str | None:
+        if key is None:
+            return default
+        entry = self.lookup(key)
+        return entry[0] if entry else default
+
+    def __contains__(self, key: str) -> bool:
+        return self.lookup(key) is not None
+
+    def is_fresh(self, key: str) -> bool:
+        entry = self.lookup(key)
+        return entry is not None and time.time() - entry[1] < self.ttl
+
+    def __setitem__(self, key: str, url: str):
+        key = key.casefold()
+        entry = (url, time.time())
+        self.remember(key, entry)
+        self.pending[key] = entry
+
+    def take_pending(self) -> list[tuple[str, str, float]]:
+        """
+        Moves the pending writes to writing, and returns them as rows for write_rows.
+        """
+        self.writing = self.pending
+        self.pending = {}
+        return [(k, url, fetched_at) for k, (url, fetched_at) in self.writing.items()]
+
+    def write_rows(self, db: sqlite3.Connection, rows: list[tuple[str, str, float]]):
+        db.executemany("INSERT OR REPLACE INTO " + self.table + " (key, url, fetched_at) VALUES (?, ?, ?)", rows)
+
+    def written(self, ok: bool):
+        if ok:
+            self.on_disk.update(self.writing)
+        else:
+            # Try again next flush, unless there's a newer entry by then
+            for k, entry in self.writing.items():
+                self.pending.setdefault(k, entry)
+        self.writing = {}
+
+# Seconds until the first retry of a miss
+MISS_BACKOFF = 15 * 60
+
+class MissCache:
+    """
+    Keys that Twitch didn't find, so they aren't asked for again every tick.
+    Each miss in a row doubles how long until the next try, from MISS_BACKOFF up to max_backoff.
+    A key that isn't tried and missed again within max_backoff after its next try is due expires,
+    so a later miss starts over from MISS_BACKOFF.
+    Only the capacity most recent misses are kept.
+    """
+
+    def __init__(self, capacity: int, max_backoff: float):
+        self.capacity = max(1, capacity)
+        self.max_backoff = max(MISS_BACKOFF, max_backoff)
+        # casefolded key -> (misses in a row, when to try again)
+        self.misses: collections.OrderedDict[str, tuple[int, float]] = collections.OrderedDict()
+
+    def expired(self, entry: tuple[int, float], now: float) -> bool:
+        return entry[1] + self.max_backoff <= now
+
+    def entry(self, key: str) -> tuple[int, float] | None:
+        """
+        The key's (misses in a row, when to try again), dropping it if it has expired.
+        """
+        entry = self.misses.get(key)
+        if entry is not None and self.expired(entry, time.time()):
+            self.misses.pop(key, None)
+            return None
+        return entry
+
+    def should_try(self, key: str) -> bool:
+        entry = self.entry(key.casefold())
+        return entry is None or entry[1] <= time.time()
+
+    def missed(self, key: str):
+        key = key.casefold()
+        entry = self.entry(key)
+        count = (entry[0] if entry else 0) + 1
+        self.misses.pop(key, None)
+        now = time.time()
+        self.misses[key] = (count, now + min(self.max_backoff, MISS_BACKOFF * 2 ** (count - 1)))
+        # The oldest misses first, so the expired ones are usually at the front
+        while self.misses:
+            oldest = next(iter(self.misses.values()))
+            if not (self.capacity < len(self.misses) or self.expired(oldest, now)):
+                break
+            self.misses.popitem(last=False)
+
+    def found(self, key: str):
+        self.misses.pop(key.casefold(), None)
+
+    def __contains__(self, key: str) -> bool:
+        return self.entry(key.casefold()) is not None
+
+db = sqlite3.connect(DB_PATH)
+# So the lookups on the event loop don't wait for a flush that's writing
+db.execute("PRAGMA journal_mode=WAL")
+# Only used by flush, one worker thread at a time
+write_db = sqlite3.connect(DB_PATH, check_same_thread=False)
+write_lock = asyncio.Lock()
+ttl = config.image_cache_ttl_hours * 60 * 60
+profile_images = ImageCache(db, "profile_images", config.image_cache_size, ttl)
+game_images = ImageCache(db, "game_images", config.image_cache_size, ttl)
+# Game names that get_games didn't find, like Discord activities that aren't Twitch categories
+game_misses = MissCache(config.image_cache_size, ttl)
+
+def write(rows: list[tuple[ImageCache, list[tuple[str, str, float]]]]):
+    for cache, cache_rows in rows:
+        cache.write_rows(write_db, cache_rows)
+    write_db.commit()
+
+async def flush():
+    """
+    Writes the new entries, in a worker thread.
+    """
+    async with write_lock:
+        caches = [profile_images, game_images]
+        if not any((cache.pending for cache in caches)):
+            return
+        rows = [(cache, cache.take_pending()) for cache in caches]
+        try:
+            await asyncio.to_thread(write, rows)
+        except Exception as e:
+            print("Could not write " + DB_PATH, flush=True)
+            traceback.print_exception(e)
+            for cache in caches:
+                cache.written(False)
+            return
+        for cache in caches:
+            cache.written(True)
@@ -0,0 +1,221 @@
+"""
+Timings of the regions of TwitchListen and of the presence handler, and counts of the Twitch and Discord API calls made,
+shown by the /stats command, and served in Prometheus's text format when metrics_port is set.
+"""
+import logging, re, time
+
+import aiohttp
+import aiohttp.web
+import config
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Histogram:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self):
+        # counts[i] is how many observations were at most BUCKETS[i]
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float):
+        self.sum += seconds
+        self.count += 1
+        for i, le in enumerate(BUCKETS):
+            if seconds <= le:
+                self.counts[i] += 1
+
+    def quantile(self, q: float) -> float | None:
+        """
+        The upper bound of the bucket that the q quantile falls in,
+        or None if it's past the last bucket.
+        """
+        rank = q * self.count
+        for i, le in enumerate(BUCKETS):
+            if rank <= self.counts[i]:
+                return le
+        return None
+
+started = time.time()
+# TwitchListen's total time per tick, and the time in each of its regions,
+# and on_presence_update's time, as presence_dropped for the updates it drops early,
+# presence_coalesced for the ones it holds for the coalescing window, and presence_update for applying them
+region_seconds: dict[str, Histogram] = {}
+# Twitch API requests by endpoint
+twitch_calls: dict[str, int] = {}
+# Discord API requests by method and route, such as "POST /channels/{id}/messages"
+discord_calls: dict[str, int] = {}
+# Rate limited and server error responses, by (service, status),
+# with the status as a string, "5xx" when only the class of error is known
+http_errors: dict[tuple[str, str], int] = {}
+# Numbers from the latest tick, such as how many streamers were live
+gauges: dict[str, float] = {}
+ticks = 0
+tick_overruns = 0
+
+def observe(region: str, seconds: float):
+    if not region in region_seconds:
+        region_seconds[region] = Histogram()
+    region_seconds[region].observe(seconds)
+
+def region_done(region: str, start: float) -> float:
+    """
+    Records the time since start for region, and returns the current time,
+    to start timing the next region from.
+    """
+    now = time.perf_counter()
+    observe(region, now - start)
+    return now
+
+def tick_done(start: float, interval: float):
+    global ticks
+    global tick_overruns
+    seconds = time.perf_counter() - start
+    observe("tick", seconds)
+    ticks += 1
+    if interval < seconds:
+        tick_overruns += 1
+
+def set_gauge(name: str, value: float):
+    gauges[name] = value
+
+def count_twitch_call(endpoint: str):
+    twitch_calls[endpoint] = twitch_calls.get(endpoint, 0) + 1
+
+def count_http_error(service: str, status: int | str):
+    key = (service, str(status))
+    http_errors[key] = http_errors.get(key, 0) + 1
+
+# ---------------------------------------------------------
+
+# Collecting
+
+def discord_route(path: str) -> str:
+    """
+    Turns a request path into its route, without the API version or any ids.
+    """
+    path = re.sub(r"^/api/v\d+", "", path)
+    return re.sub(r"/\d+", "/{id}", path)
+
+async def on_discord_request_end(session: aiohttp.ClientSession, context, params: aiohttp.TraceRequestEndParams):
+    endpoint = params.method + " " + discord_route(params.url.path)
+    discord_calls[endpoint] = discord_calls.get(endpoint, 0) + 1
+    status = params.response.status
+    if status == 429 or 500 <= status:
+        count_http_error("discord", status)
+
+def discord_trace() -> aiohttp.TraceConfig:
+    """
+    For discord.Client's http_trace, to count every request discord.py makes,
+    including the 429s and 5xxs that it retries on its own.
+    """
+    trace = aiohttp.TraceConfig()
+    trace.on_request_end.append(on_discord_request_end)
+    return trace
+
+class TwitchRateLimitCounter(logging.Handler):
+    """
+    The twitchAPI library waits out a 429 by itself, and only logs that it did.
+    """
+
+    def emit(self, record: logging.LogRecord):
+        if record.getMessage().startswith("reached rate limit"):
+            count_http_error("twitch", 429)
+
+logging.getLogger("twitchAPI.twitch").addHandler(TwitchRateLimitCounter(logging.WARNING))
+
+# ---------------------------------------------------------
+
+# Reporting
+
+def format_seconds(seconds: float | None) -> str:
+    if seconds is None:
+        return ">" + str(BUCKETS[-1]) + "s"
+    if seconds < 1:
+        return str(round(seconds * 1000)) + "ms"
+    return str(seconds) + "s"
+
+def format_stats() -> str:
+    """
+    A plain text summary, for the /stats command.
+    """
+    uptime = int(time.time() - started)
+    lines = [
+        "Uptime: " + str(uptime // 3600) + "h " + str(uptime // 60 % 60) + "m",
+        "Ticks: " + str(ticks) + ", overruns: " + str(tick_overruns),
+    ]
+    for name, value in sorted(gauges.items()):
+        lines.append(name.replace("_", " ").capitalize() + ": " + str(round(value)))
+    lines.append("")
+    lines.append("Region timings, count / mean / p50 / p99:")
+    for region, h in sorted(region_seconds.items()):
+        mean = h.sum / h.count if h.count else 0.0
+        lines.append("  " + region + ": " + str(h.count) + " / " + format_seconds(round(mean, 3)) + " / " + format_seconds(h.quantile(0.5)) + " / " + format_seconds(h.quantile(0.99)))
+    lines.append("")
+    lines.append("Twitch calls:")
+    for endpoint, n in sorted(twitch_calls.items()):
+        lines.append("  " + endpoint + ": " + str(n))
+    lines.append("Discord calls:")
+    for endpoint, n in sorted(discord_calls.items(), key=lambda kv: -kv[1])[:10]:
+        lines.append("  " + endpoint + ": " + str(n))
+    if http_errors:
+        lines.append("Rate limits and server errors:")
+        for (service, status), n in sorted(http_errors.items()):
+            lines.append("  " + service + " " + status + ": " + str(n))
+    return "\n".join(lines)
+
+def label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def render_prometheus() -> str:
+    lines = [
+        "# HELP matostreamshow_region_seconds Time spent in each region of TwitchListen, in whole ticks, and in presence updates.",
+        "# TYPE matostreamshow_region_seconds histogram",
+    ]
+    for region, h in sorted(region_seconds.items()):
+        for le, n in zip(BUCKETS, h.counts):
+            lines.append("matostreamshow_region_seconds_bucket{region=\"" + label(region) + "\",le=\"" + str(le) + "\"} " + str(n))
+        lines.append("matostreamshow_region_seconds_bucket{region=\"" + label(region) + "\",le=\"+Inf\"} " + str(h.count))
+        lines.append("matostreamshow_region_seconds_sum{region=\"" + label(region) + "\"} " + str(h.sum))
+        lines.append("matostreamshow_region_seconds_count{region=\"" + label(region) + "\"} " + str(h.count))
+    lines.append("# HELP matostreamshow_ticks_total TwitchListen ticks run.")
+    lines.append("# TYPE matostreamshow_ticks_total counter")
+    lines.append("matostreamshow_ticks_total " + str(ticks))
+    lines.append("# HELP matostreamshow_tick_overruns_total TwitchListen ticks that took longer than the loop interval.")
+    lines.append("# TYPE matostreamshow_tick_overruns_total counter")
+    lines.append("matostreamshow_tick_overruns_total " + str(tick_overruns))
+    lines.append("# HELP matostreamshow_twitch_calls_total Twitch API requests, by endpoint.")
+    lines.append("# TYPE matostreamshow_twitch_calls_total counter")
+    for endpoint, n in sorted(twitch_calls.items()):
+        lines.append("matostreamshow_twitch_calls_total{endpoint=\"" + label(endpoint) + "\"} " + str(n))
+    lines.append("# HELP matostreamshow_discord_calls_total Discord API requests, by method and route.")
+    lines.append("# TYPE matostreamshow_discord_calls_total counter")
+    for endpoint, n in sorted(discord_calls.items()):
+        lines.append("matostreamshow_discord_calls_total{endpoint=\"" + label(endpoint) + "\"} " + str(n))
+    lines.append("# HELP matostreamshow_http_errors_total Rate limited and server error responses, by service and status.")
+    lines.append("# TYPE matostreamshow_http_errors_total counter")
+    for (service, status), n in sorted(http_errors.items()):
+        lines.append("matostreamshow_http_errors_total{service=\"" + service + "\",status=\"" + status + "\"} " + str(n))
+    for name, value in sorted(gauges.items()):
+        lines.append("# TYPE matostreamshow_" + name + " gauge")
+        lines.append("matostreamshow_" + name + " " + str(value))
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request: aiohttp.web.Request) -> aiohttp.web.Response:
+    return aiohttp.web.Response(text=render_prometheus(), content_type="text/plain", charset="utf-8")
+
+async def start_server() -> aiohttp.web.AppRunner | None:
+    """
+    Serves /metrics on metrics_host and metrics_port, if metrics_port is set.
+    """
+    if config.metrics_port is None:
+        return None
+    app = aiohttp.web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = aiohttp.web.AppRunner(app)
+    await runner.setup()
+    await aiohttp.web.TCPSite(runner, config.metrics_host, config.metrics_port).start()
+    print("Serving metrics on http://" + config.metrics_host + ":" + str(config.metrics_port) + "/metrics", flush=True)
+    return runner
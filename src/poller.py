@@ -0,0 +1,349 @@
+"""
+Polls Twitch for the streamers that bot processes watch, and publishes what's live to them
+over a Unix socket, so several bot processes or shards can share one set of Helix requests,
+and a slow Helix response doesn't hold up any bot's Discord work.
+
+Run:
+python src/poller.py
+with poller_socket set in config.json, then start the bots with the same poller_socket.
+
+Each message is one line of JSON.
+A bot sends {"watch": [casefolded logins], "priority": [casefolded logins], "ids": {login: user id}}
+when it connects, and whenever the streamers it watches change,
+with the priority streamers to poll every time, and the user ids to poll them by.
+Logins without a user id aren't polled.
+The poller answers with {"snapshot": {login: stream}, "polled": [logins]} for that bot's logins,
+and after every poll sends {"online": {login: stream}, "offline": [logins], "polled": [logins]},
+with the streams that went live or changed, the ones that went offline,
+and the logins that poll succeeded for.
+"""
+import asyncio, datetime, json, os, traceback
+from collections import namedtuple
+from typing import Awaitable, Callable
+
+import config
+import eventsub
+import helix
+import schedule
+from twitchAPI.twitch import Twitch
+
+# The fields of a twitchAPI Stream that the bot uses
+PolledStream = namedtuple(
+    "PolledStream",
+    [
+        "user_name",
+        "user_id",
+        "game_id",
+        "game_name",
+        "title",
+        "thumbnail_url",
+        "started_at",
+    ],
+)
+
+def stream_to_json(s: PolledStream) -> dict:
+    return {
+        "user_name": s.user_name,
+        "user_id": s.user_id,
+        "game_id": s.game_id,
+        "game_name": s.game_name,
+        "title": s.title,
+        "thumbnail_url": s.thumbnail_url,
+        "started_at": s.started_at.isoformat(),
+    }
+
+def stream_of_json(j: dict) -> PolledStream:
+    return PolledStream(
+        user_name=j["user_name"],
+        user_id=j.get("user_id"),
+        game_id=j.get("game_id"),
+        game_name=j["game_name"],
+        title=j["title"],
+        thumbnail_url=j["thumbnail_url"],
+        started_at=datetime.datetime.fromisoformat(j["started_at"]),
+    )
+
+def encode(msg: dict) -> bytes:
+    return (json.dumps(msg) + "\n").encode()
+
+# ---------------------------------------------------------
+
+# Poller side
+
+class Subscriber:
+    __slots__ = ("writer", "watch", "priority", "user_ids")
+
+    def __init__(self, writer: asyncio.StreamWriter):
+        self.writer = writer
+        self.watch: set[str] = set()
+        self.priority: set[str] = set()
+        # casefolded login -> user id
+        self.user_ids: dict[str, str] = {}
+
+class Poller:
+    """
+    Polls the union of what every connected bot watches,
+    and sends each bot the changes to the streamers it watches.
+    """
+
+    def __init__(self, api: Twitch):
+        self.api = api
+        self.subscribers: set[Subscriber] = set()
+        # casefolded login -> stream, for the ones that are live
+        self.streams: dict[str, PolledStream] = {}
+        # Logins that have been polled at least once
+        self.polled: set[str] = set()
+        self.stream_events: eventsub.StreamEvents | None = None
+
+    def watched(self) -> set[str]:
+        lower_set: set[str] = set()
+        for sub in self.subscribers:
+            lower_set.update(sub.watch)
+        return lower_set
+
+    def priority(self) -> set[str]:
+        lower_set: set[str] = set()
+        for sub in self.subscribers:
+            lower_set.update(sub.priority)
+        return lower_set
+
+    def user_ids(self) -> dict[str, str]:
+        user_ids: dict[str, str] = {}
+        for sub in self.subscribers:
+            user_ids.update(sub.user_ids)
+        return user_ids
+
+    async def handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sub = Subscriber(writer)
+        self.subscribers.add(sub)
+        try:
+            while line := await reader.readline():
+                msg = json.loads(line)
+                if "watch" in msg:
+                    sub.watch = set(msg["watch"])
+                    sub.priority = set(msg.get("priority", []))
+                    sub.user_ids = msg.get("ids", {})
+                    await self.send(sub, {
+                        "snapshot": {n: stream_to_json(self.streams[n]) for n in sub.watch if n in self.streams},
+                        "polled": [n for n in sub.watch if n in self.polled],
+                    })
+                    self.sync_stream_events()
+        except (OSError, ValueError) as e:
+            print("Error reading from a bot", flush=True)
+            traceback.print_exception(e)
+        finally:
+            self.subscribers.discard(sub)
+            writer.close()
+
+    async def send(self, sub: Subscriber, msg: dict):
+        try:
+            sub.writer.write(encode(msg))
+            await sub.writer.drain()
+        except OSError:
+            # It disconnected, handle will clean up after it
+            self.subscribers.discard(sub)
+
+    async def poll(self, lower_names: set[str]):
+        online: dict[str, PolledStream] = {}
+        offline: list[str] = []
+        polled: set[str] = set()
+        user_ids = self.user_ids()
+        logins = {user_id: n for n, user_id in user_ids.items()}
+        for batch, streams in await helix.gather_streams_by_id(self.api, lower_names, user_ids):
+            if isinstance(streams, BaseException):
+                # Keep what's known about this batch until a poll of it succeeds
+                print("Twitch API Error in poll", flush=True)
+                traceback.print_exception(streams)
+                continue
+            polled.update(batch)
+            live: dict[str, PolledStream] = {}
+            for stream in streams:
+                lower_name = logins.get(stream.user_id) or stream.user_name.casefold()
+                schedule.poll_schedule.record_live(lower_name)
+                live[lower_name] = PolledStream(
+                    user_name=stream.user_name,
+                    user_id=stream.user_id,
+                    game_id=stream.game_id or None,
+                    game_name=stream.game_name,
+                    title=stream.title,
+                    thumbnail_url=stream.thumbnail_url,
+                    started_at=stream.started_at,
+                )
+            for lower_name in batch:
+                stream = live.get(lower_name)
+                if stream:
+                    if self.streams.get(lower_name) != stream:
+                        self.streams[lower_name] = stream
+                        online[lower_name] = stream
+                elif lower_name in self.streams:
+                    self.streams.pop(lower_name, None)
+                    offline.append(lower_name)
+        self.polled.update(polled)
+        await self.publish(online, offline, polled)
+
+    async def publish(self, online: dict[str, PolledStream], offline: list[str], polled: set[str]):
+        await asyncio.gather(*(self.send(sub, {
+            "online": {n: stream_to_json(s) for n, s in online.items() if n in sub.watch},
+            "offline": [n for n in offline if n in sub.watch],
+            "polled": [n for n in polled if n in sub.watch],
+        }) for sub in list(self.subscribers)))
+
+    async def start_stream_events(self):
+        if not config.eventsub_mode:
+            return
+        try:
+            if config.eventsub_mode == "websocket":
+                await self.api.set_user_authentication(config.twitch_user_token, [], config.twitch_user_refresh_token)
+            self.stream_events = eventsub.StreamEvents(self.api, self.on_online, self.on_offline)
+            await self.stream_events.start()
+        except Exception as e:
+            print("Could not start Twitch EventSub, polling instead", flush=True)
+            traceback.print_exception(e)
+            self.stream_events = None
+
+    def sync_stream_events(self):
+        if self.stream_events:
+            asyncio.create_task(self.stream_events.sync(self.watched(), self.user_ids()))
+
+    async def on_online(self, lower_name: str):
+        async def poll() -> bool:
+            await self.poll({lower_name})
+            return lower_name in self.streams
+        await eventsub.poll_until_live(poll)
+
+    async def on_offline(self, lower_name: str):
+        if lower_name in self.streams:
+            self.streams.pop(lower_name, None)
+            await self.publish({}, [lower_name], set())
+
+async def run_poller():
+    if not config.poller_socket:
+        raise ValueError("config poller_socket not found")
+    if (not config.twitch_api_id) or (not config.twitch_api_secret):
+        raise ValueError("config twitch_api_id and twitch_api_secret are needed to poll")
+    api = await Twitch(config.twitch_api_id, config.twitch_api_secret, True, [])
+    poller = Poller(api)
+    if os.path.exists(config.poller_socket):
+        # Left behind by a previous run
+        os.remove(config.poller_socket)
+    server = await asyncio.start_unix_server(poller.handle, path=config.poller_socket)
+    await poller.start_stream_events()
+    print("Poller listening on " + config.poller_socket, flush=True)
+    reconciledown = 0
+    flushdown = 0
+    async with server:
+        while True:
+            if 0 < reconciledown:
+                reconciledown -= 1
+            else:
+                # With EventSub, polling is only a fallback to reconcile missed events
+                reconciledown = config.eventsub_reconcile_ticks if poller.stream_events else 0
+                poller.sync_stream_events()
+                try:
+                    await poller.poll(schedule.poll_schedule.due(poller.watched(), poller.priority()))
+                except Exception as e:
+                    print("Error in poll", flush=True)
+                    traceback.print_exception(e)
+            if 0 < flushdown:
+                flushdown -= 1
+            else:
+                flushdown = config.history_rescan_ticks
+                await schedule.poll_schedule.flush()
+            await asyncio.sleep(60)
+
+# ---------------------------------------------------------
+
+# Bot side
+
+class PollerClient:
+    """
+    Subscribes a bot process to the poller at path, reconnecting when it goes away,
+    and keeps the latest streams it published for the logins this bot watches.
+    on_update is called with each poll's changes, the streams that went live or changed,
+    and the logins that went offline.
+    """
+
+    def __init__(self, path: str, on_update: Callable[[dict[str, PolledStream], list[str]], Awaitable[None]]):
+        self.path = path
+        self.on_update = on_update
+        self.watch: set[str] = set()
+        self.priority: set[str] = set()
+        self.user_ids: dict[str, str] = {}
+        self.streams: dict[str, PolledStream] = {}
+        # Logins the poller has polled, so whether they're live is known
+        self.polled: set[str] = set()
+        self.writer: asyncio.StreamWriter | None = None
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def connected(self) -> bool:
+        return self.writer is not None
+
+    def set_watch(self, lower_set: set[str], priority: set[str], user_ids: dict[str, str]):
+        self.watch = set(lower_set)
+        self.priority = set(priority)
+        self.user_ids = {n: user_ids[n] for n in self.watch if n in user_ids}
+        if self.writer:
+            self.writer.write(encode({"watch": sorted(self.watch), "priority": sorted(self.priority), "ids": self.user_ids}))
+
+    def batch(self, lower_set: set[str]) -> tuple[tuple[str, ...], list[PolledStream]]:
+        """
+        Returns the logins in lower_set that the poller knows about,
+        and the streams of the ones that are live,
+        in the same shape as a batch of get_streams.
+        """
+        batch = tuple((n for n in lower_set if n in self.polled))
+        return batch, [self.streams[n] for n in batch if n in self.streams]
+
+    async def run(self):
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.path)
+            except OSError as e:
+                print("Could not connect to the poller at " + self.path + ": " + str(e), flush=True)
+                await asyncio.sleep(5)
+                continue
+            self.writer = writer
+            self.set_watch(self.watch, self.priority, self.user_ids)
+            try:
+                while line := await reader.readline():
+                    await self.handle(json.loads(line))
+            except (OSError, ValueError) as e:
+                print("Error reading from the poller", flush=True)
+                traceback.print_exception(e)
+            finally:
+                self.writer = None
+                self.polled.clear()
+                writer.close()
+            print("Lost the connection to the poller, reconnecting", flush=True)
+            await asyncio.sleep(5)
+
+    async def handle(self, msg: dict):
+        if "snapshot" in msg:
+            self.streams = {n: stream_of_json(j) for n, j in msg["snapshot"].items()}
+            self.polled = set(msg["polled"])
+            return
+        online = {n: stream_of_json(j) for n, j in msg["online"].items()}
+        offline: list[str] = msg["offline"]
+        self.streams.update(online)
+        for lower_name in offline:
+            self.streams.pop(lower_name, None)
+        self.polled.update(msg["polled"])
+        if not (online or offline):
+            return
+        try:
+            await self.on_update(online, offline)
+        except Exception as e:
+            print("Error handling an update from the poller", flush=True)
+            traceback.print_exception(e)
+
+if __name__ == "__main__":
+    asyncio.run(run_poller())
@@ -1,32 +1,138 @@
-import copy, discord, json, os, shutil
+import asyncio, copy, traceback, types
+from collections import namedtuple
+
+import config
+import storage
 
 JSON_PATH = "save.json"
 
+# Bumped whenever migrate_guild learns a new migration
+SCHEMA_VERSION = 1
+
 FULL_TEMPLATE = {
+    "version": SCHEMA_VERSION,
     "guild_template": {
         "name": "",  # Note: automatically set to guild name on addition
         "channel_id": 0,
         "streamer_role_id": 0,
         "live_role_id": 0,
         "twitch_streamer_list": [],
-        "twitch_category_list": []
+        "twitch_category_list": [],
+        "streamer_roles": {},
+        "muted_role_list": [],
+        "priority_streamer_list": [],
+        "twitch_user_ids": {}
     },
     "guilds": {}
 }
 
 data: dict = {}  # Do not access directly - use get_guild_data instead
 
-def save():
-    # For write-time safety - if we error mid-write then contents of the file won't be completed!
-    if os.path.exists(JSON_PATH):
-        shutil.copy2(JSON_PATH, JSON_PATH + ".bak")
+# Each guild's configuration compiled for the hot paths, built on first use,
+# and dropped whenever the guild is saved, so that it's rebuilt after every change
+GuildView = namedtuple(
+    "GuildView",
+    [
+        "channel_id",
+        "live_role_id",
+        # Streamer role ids, and the ones of those that the category filter applies to
+        "streamer_role_ids",
+        "filtered_role_ids",
+        "muted_role_ids",
+        # Casefolded category names
+        "categories",
+        # Casefolded login -> login as written in twitch_streamer_list
+        "streamers",
+    ],
+)
+views: dict[str, GuildView] = {}
+
+# Where data is stored, chosen by config.storage
+backend: storage.JsonStorage | storage.SqliteStorage = storage.SqliteStorage(config.sqlite_path) if config.storage == "sqlite" else storage.JsonStorage(JSON_PATH)
+
+dirty_all = False
+dirty_guilds: set[str] = set()
+flush_task: asyncio.Task | None = None
+write_lock = asyncio.Lock()
+
+def save(guild_id: str | None = None):
+    """
+    Marks one guild's data as changed, or all the data when guild_id is None,
+    to be written within config.save_interval seconds.
+    Writing happens in a worker thread, so that it doesn't block the event loop,
+    or right away when there's no event loop running yet.
+    """
+    global dirty_all
+    global flush_task
+    if guild_id is None:
+        dirty_all = True
+        views.clear()
+    else:
+        dirty_guilds.add(guild_id)
+        views.pop(guild_id, None)
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        snapshot, _ = take_snapshot()
+        backend.write(snapshot)
+        return
+    if flush_task is None or flush_task.done():
+        flush_task = loop.create_task(flush_later())
 
-    with open(JSON_PATH, "w") as f:
-        json.dump(data, f, indent=4)
+def take_snapshot() -> tuple[dict, set[str] | None]:
+    global dirty_all
+    guild_ids = None if dirty_all else set(dirty_guilds)
+    dirty_all = False
+    dirty_guilds.clear()
+    return backend.snapshot(data, guild_ids), guild_ids
+
+async def flush_later():
+    """
+    Flushes after config.save_interval, and again for as long as there are changes,
+    such as ones saved while a write was in its worker thread, or ones whose write failed.
+    """
+    while True:
+        await asyncio.sleep(config.save_interval)
+        try:
+            await flush()
+        except Exception as e:
+            print("Could not write the save data, trying again", flush=True)
+            traceback.print_exception(e)
+        if not (dirty_all or dirty_guilds):
+            return
+
+async def flush():
+    """
+    Writes any changes now, such as on shutdown.
+    """
+    global dirty_all
+    async with write_lock:
+        if not (dirty_all or dirty_guilds):
+            return
+        snapshot, guild_ids = take_snapshot()
+        try:
+            await asyncio.to_thread(backend.write, snapshot)
+        except Exception:
+            if guild_ids is None:
+                dirty_all = True
+            else:
+                dirty_guilds.update(guild_ids)
+            raise
 
 def get_guild_ids() -> list[str]:
     return data["guilds"].keys()
 
+def owns_guild(guild_id: str) -> bool:
+    """
+    Whether this process handles guild_id, when it only runs some of the shards.
+    """
+    if config.shard_count is None or config.shard_ids is None:
+        return True
+    return (int(guild_id) >> 22) % config.shard_count in config.shard_ids
+
+def get_owned_guild_ids() -> list[str]:
+    return [g for g in get_guild_ids() if owns_guild(g)]
+
 def get_guild_data(guild_id: str) -> dict:
     if guild_id not in data["guilds"]:
         print("Guild not found: instantiating")
@@ -35,28 +141,210 @@ def get_guild_data(guild_id: str) -> dict:
 
 def init_guild_data(guild_id: str):
     data["guilds"][guild_id] = copy.deepcopy(data["guild_template"])
-    save()
+    save(guild_id)
+
+def compile_guild(d: dict) -> GuildView:
+    streamer_roles = {int(k): filtered for k, filtered in d["streamer_roles"].items() if int(k) != 0}
+    return GuildView(
+        channel_id=d["channel_id"] or 0,
+        live_role_id=d["live_role_id"] or 0,
+        streamer_role_ids=frozenset(streamer_roles.keys()),
+        filtered_role_ids=frozenset((k for k, filtered in streamer_roles.items() if filtered)),
+        muted_role_ids=frozenset(d["muted_role_list"]),
+        categories=frozenset((c.casefold() for c in d["twitch_category_list"])),
+        streamers=types.MappingProxyType({s.casefold(): s for s in d["twitch_streamer_list"]}),
+    )
+
+def get_guild_view(guild_id: str) -> GuildView:
+    view = views.get(guild_id)
+    if view is None:
+        view = compile_guild(get_guild_data(guild_id))
+        views[guild_id] = view
+    return view
 
-if not os.path.exists(JSON_PATH):
+def migrate_guild(d: dict):
+    if not "streamer_roles" in d:
+        d["streamer_roles"] = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
+    if not "muted_role_list" in d:
+        d["muted_role_list"] = []
+    if not "priority_streamer_list" in d:
+        d["priority_streamer_list"] = []
+    if not "twitch_user_ids" in d:
+        d["twitch_user_ids"] = {}
+
+def migrate() -> bool:
+    """
+    Brings data saved by an older version up to SCHEMA_VERSION, once when it's loaded,
+    so that nothing else has to check for missing fields.
+    Returns whether anything was migrated.
+    """
+    if SCHEMA_VERSION <= data.get("version", 0):
+        return False
+    migrate_guild(data["guild_template"])
+    for d in data["guilds"].values():
+        migrate_guild(d)
+    data["version"] = SCHEMA_VERSION
+    return True
+
+loaded = backend.load()
+if loaded is None:
     data = FULL_TEMPLATE
     save()
 else:
-    with open(JSON_PATH) as f:
-        try:
-            data = json.load(f)
-        except json.JSONDecodeError:
-            print("Could not deserialise save.json - loading backup")
-            with open(JSON_PATH + ".bak") as f2:
-                data = json.load(f2)
-    save()
+    data = loaded
+    if migrate() or isinstance(backend, storage.JsonStorage):
+        save()
 
-def get_lower_set_all() -> set[str]:
-    lower_set_all: set[str] = set()
-    for g in get_guild_ids():
-        d = get_guild_data(g)
-        dc_id = d["channel_id"]
-        if not (dc_id and dc_id != 0):
+# Inverted index over the twitch_streamer_list of every guild with a channel
+# that this process owns, from casefolded login to { guild_id: login as written in that guild's list }.
+# Kept up to date by index_guild, index_streamer, and unindex_streamer.
+streamer_guilds: dict[str, dict[str, str]] = {}
+indexed_guild_names: dict[str, set[str]] = {}
+# Twitch user ids of the indexed streamers, from each guild's twitch_user_ids,
+# by casefolded login, and casefolded logins by user id
+user_ids: dict[str, str] = {}
+user_logins: dict[str, str] = {}
+
+def forget_user_id(lower_name: str):
+    user_id = user_ids.pop(lower_name, None)
+    if user_id is not None and user_logins.get(user_id) == lower_name:
+        user_logins.pop(user_id, None)
+
+def unindex_guild(guild_id: str):
+    for lower_name in indexed_guild_names.pop(guild_id, set()):
+        guilds = streamer_guilds.get(lower_name)
+        if guilds is None:
             continue
-        cap_l = d["twitch_streamer_list"]
-        lower_set_all.update((u.casefold() for u in cap_l))
-    return lower_set_all
+        guilds.pop(guild_id, None)
+        if not guilds:
+            streamer_guilds.pop(lower_name, None)
+            forget_user_id(lower_name)
+
+def index_guild(guild_id: str):
+    """
+    Re-indexes all of one guild's streamers.
+    Call after the guild's channel changes.
+    """
+    unindex_guild(guild_id)
+    if not owns_guild(guild_id):
+        return
+    d = data["guilds"][guild_id]
+    dc_id = d["channel_id"]
+    if not (dc_id and dc_id != 0):
+        return
+    for cap_name in d["twitch_streamer_list"]:
+        index_streamer(guild_id, cap_name)
+
+def index_streamer(guild_id: str, cap_name: str):
+    if not owns_guild(guild_id):
+        return
+    d = data["guilds"][guild_id]
+    dc_id = d["channel_id"]
+    if not (dc_id and dc_id != 0):
+        return
+    lower_name = cap_name.casefold()
+    if not lower_name in streamer_guilds:
+        streamer_guilds[lower_name] = {}
+    streamer_guilds[lower_name][guild_id] = cap_name
+    if not guild_id in indexed_guild_names:
+        indexed_guild_names[guild_id] = set()
+    indexed_guild_names[guild_id].add(lower_name)
+    user_id = d["twitch_user_ids"].get(lower_name)
+    if user_id:
+        user_ids[lower_name] = user_id
+        user_logins[user_id] = lower_name
+
+def unindex_streamer(guild_id: str, cap_name: str):
+    lower_name = cap_name.casefold()
+    guilds = streamer_guilds.get(lower_name)
+    if guilds is not None:
+        guilds.pop(guild_id, None)
+        if not guilds:
+            streamer_guilds.pop(lower_name, None)
+            forget_user_id(lower_name)
+    if guild_id in indexed_guild_names:
+        indexed_guild_names[guild_id].discard(lower_name)
+
+def rebuild_index():
+    streamer_guilds.clear()
+    indexed_guild_names.clear()
+    user_ids.clear()
+    user_logins.clear()
+    for g in get_guild_ids():
+        index_guild(g)
+
+rebuild_index()
+
+def get_lower_set_all() -> set[str]:
+    return set(streamer_guilds.keys())
+
+def get_priority_set() -> set[str]:
+    """
+    Returns the casefolded priority streamers of every guild with a channel that this process owns.
+    """
+    lower_set: set[str] = set()
+    for guild_id in indexed_guild_names.keys():
+        lower_set.update((s.casefold() for s in data["guilds"][guild_id]["priority_streamer_list"]))
+    return lower_set
+
+def get_streamer_guilds(lower_name: str) -> dict[str, str]:
+    """
+    Returns { guild_id: login as written in that guild's list }
+    for every guild with a channel that watches lower_name.
+    """
+    return streamer_guilds.get(lower_name, {})
+
+def replace_name(l: list[str], lower_name: str, cap_name: str | None):
+    """
+    Replaces lower_name in l, matched case-insensitively, with cap_name,
+    or removes it when cap_name is None or l already has cap_name.
+    """
+    for i, e in enumerate(l):
+        if e.casefold() == lower_name:
+            if cap_name is None or any((s.casefold() == cap_name.casefold() for s in l if s is not e)):
+                l.pop(i)
+            else:
+                l[i] = cap_name
+                l.sort(key=str.casefold)
+            return
+
+def set_user_id(lower_name: str, user_id: str | None, cap_name: str | None = None):
+    """
+    Records lower_name's Twitch user id in every indexed guild that watches it,
+    or forgets it when user_id is None,
+    and writes lower_name as cap_name in their lists if that's given.
+    """
+    for guild_id, old_cap_name in list(get_streamer_guilds(lower_name).items()):
+        d = data["guilds"][guild_id]
+        changed = d["twitch_user_ids"].get(lower_name) != user_id
+        if user_id:
+            d["twitch_user_ids"][lower_name] = user_id
+        else:
+            d["twitch_user_ids"].pop(lower_name, None)
+        if cap_name and cap_name != old_cap_name:
+            replace_name(d["twitch_streamer_list"], lower_name, cap_name)
+            replace_name(d["priority_streamer_list"], lower_name, cap_name)
+            streamer_guilds[lower_name][guild_id] = cap_name
+            changed = True
+        if changed:
+            save(guild_id)
+    forget_user_id(lower_name)
+    if user_id and lower_name in streamer_guilds:
+        user_ids[lower_name] = user_id
+        user_logins[user_id] = lower_name
+
+def rename_streamer(lower_name: str, cap_name: str, user_id: str):
+    """
+    Follows a Twitch account that was renamed from lower_name to cap_name,
+    in every indexed guild that watches it.
+    """
+    new_lower_name = cap_name.casefold()
+    for guild_id, old_cap_name in list(get_streamer_guilds(lower_name).items()):
+        d = data["guilds"][guild_id]
+        replace_name(d["twitch_streamer_list"], lower_name, cap_name)
+        replace_name(d["priority_streamer_list"], lower_name, cap_name)
+        d["twitch_user_ids"].pop(lower_name, None)
+        d["twitch_user_ids"][new_lower_name] = user_id
+        unindex_streamer(guild_id, old_cap_name)
+        index_streamer(guild_id, cap_name)
+        save(guild_id)
@@ -0,0 +1,102 @@
+"""
+Decides which watched Twitch logins to poll each time, from how recently each one was live.
+
+Logins that are live, were live in the last week, or started being watched in the last week,
+are polled every time. Ones last live in the last month are polled every 5th time,
+and the rest every 15th time, spread out so each poll has about the same number of them.
+Priority streamers, set with /priority-streamer-add, are always polled every time.
+
+When each login was last seen live is kept in poll_history.json, so it survives restarts.
+Logins that aren't watched anymore are dropped from it when it's written.
+"""
+import asyncio, time, traceback, zlib
+
+import config
+import storage
+
+HISTORY_PATH = "poll_history.json"
+DAY = 24 * 60 * 60
+
+# (days since last live, or since first watched if it hasn't been seen live, polls between polls of it)
+TIERS = [(7, 1), (30, 5), (None, 15)]
+
+class PollSchedule:
+    def __init__(self, path: str):
+        self.backend = storage.JsonStorage(path)
+        # casefolded login -> when it was last seen live, as a unix timestamp
+        self.last_live: dict[str, float] = {}
+        # casefolded login -> when it was first watched
+        self.first_seen: dict[str, float] = {}
+        self.polls = 0
+        self.dirty = False
+        # The logins passed to the latest due, which the history is pruned to
+        self.watched: set[str] = set()
+        loaded = self.backend.load()
+        if loaded:
+            self.last_live = loaded.get("last_live", {})
+            self.first_seen = loaded.get("first_seen", {})
+
+    def period(self, lower_name: str, now: float) -> int:
+        since = now - max(self.last_live.get(lower_name, 0), self.first_seen.get(lower_name, now))
+        for days, polls in TIERS:
+            if days is None or since < days * DAY:
+                return polls
+        return 1
+
+    def due(self, lower_set: set[str], priority: set[str]) -> set[str]:
+        """
+        Returns the logins in lower_set to poll this time.
+        """
+        self.watched = lower_set
+        if not config.adaptive_polling:
+            return lower_set
+        now = time.time()
+        self.polls += 1
+        due: set[str] = set()
+        for lower_name in lower_set:
+            if not lower_name in self.first_seen:
+                self.first_seen[lower_name] = now
+                self.dirty = True
+            if lower_name in priority:
+                due.add(lower_name)
+                continue
+            period = self.period(lower_name, now)
+            # crc32 rather than hash, so that the spread is the same across restarts
+            if period <= 1 or (self.polls + zlib.crc32(lower_name.encode())) % period == 0:
+                due.add(lower_name)
+        return due
+
+    def record_live(self, lower_name: str):
+        self.last_live[lower_name] = time.time()
+        self.dirty = True
+
+    def prune(self):
+        """
+        Drops the logins that aren't watched anymore.
+        Nothing is dropped before anything is watched, such as a poller that no bot has connected to yet.
+        """
+        if not self.watched:
+            return
+        for history in (self.last_live, self.first_seen):
+            for lower_name in [n for n in history if not n in self.watched]:
+                history.pop(lower_name, None)
+                self.dirty = True
+
+    async def flush(self):
+        """
+        Writes the history if it changed, in a worker thread.
+        A failed write is reported, and tried again by the next flush.
+        """
+        self.prune()
+        if not self.dirty:
+            return
+        self.dirty = False
+        snapshot = self.backend.snapshot({"last_live": self.last_live, "first_seen": self.first_seen}, None)
+        try:
+            await asyncio.to_thread(self.backend.write, snapshot)
+        except Exception as e:
+            self.dirty = True
+            print("Could not write " + HISTORY_PATH + ", trying again next time", flush=True)
+            traceback.print_exception(e)
+
+poll_schedule = PollSchedule(HISTORY_PATH)
@@ -0,0 +1,226 @@
+"""
+Storage backends for the guild configuration kept by save.py.
+
+Run:
+python src/storage.py import [save.json] [save.db]
+to copy an existing save.json, or its .bak if it's unreadable, into a SQLite database.
+"""
+import copy, json, os, shutil, sqlite3, sys, threading
+
+class JsonStorage:
+    """
+    Keeps everything in one JSON file, which is rewritten whole on every write.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def load(self) -> dict | None:
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path) as f:
+            try:
+                return json.load(f)
+            except json.JSONDecodeError:
+                print("Could not deserialise " + self.path + " - loading backup")
+                with open(self.path + ".bak") as f2:
+                    return json.load(f2)
+
+    def snapshot(self, data: dict, guild_ids: set[str] | None) -> dict:
+        return copy.deepcopy(data)
+
+    def write(self, snapshot: dict):
+        text = json.dumps(snapshot, indent=4)
+        # For write-time safety - if we error mid-write then contents of the file won't be completed!
+        # So write to a temporary file and then replace, which is atomic
+        # The pid keeps two processes writing the same file from sharing a temporary file
+        tmp_path = self.path + "." + str(os.getpid()) + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(self.path):
+            shutil.copy2(self.path, self.path + ".bak")
+        os.replace(tmp_path, self.path)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    channel_id INTEGER NOT NULL,
+    streamer_role_id INTEGER NOT NULL,
+    live_role_id INTEGER NOT NULL,
+    extra TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS streamers (
+    guild_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    login TEXT NOT NULL,
+    PRIMARY KEY (guild_id, position)
+);
+CREATE TABLE IF NOT EXISTS categories (
+    guild_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    PRIMARY KEY (guild_id, position)
+);
+CREATE TABLE IF NOT EXISTS streamer_roles (
+    guild_id TEXT NOT NULL,
+    role_id INTEGER NOT NULL,
+    filtered INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, role_id)
+);
+CREATE TABLE IF NOT EXISTS muted_roles (
+    guild_id TEXT NOT NULL,
+    role_id INTEGER NOT NULL,
+    PRIMARY KEY (guild_id, role_id)
+);
+"""
+
+# Guild fields with their own columns or tables, anything else goes in guilds.extra as JSON
+GUILD_COLUMNS = ["name", "channel_id", "streamer_role_id", "live_role_id"]
+GUILD_TABLES = ["twitch_streamer_list", "twitch_category_list", "streamer_roles", "muted_role_list"]
+CHILD_TABLES = ["streamers", "categories", "streamer_roles", "muted_roles"]
+
+class SqliteStorage:
+    """
+    Keeps each guild in its own rows, so a write only touches the guilds that changed,
+    in one transaction.
+    Older guilds without streamer_roles or muted_role_list are written as if
+    the lazy migrations had already run on them.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.lock:
+            self.db.executescript(SCHEMA)
+            self.drop_login_lower()
+            self.db.commit()
+
+    def drop_login_lower(self):
+        """
+        Rebuilds the streamers table of a database written by an older version without its login_lower column,
+        which nothing queries now that save.streamer_guilds indexes the streamers in memory.
+        Rebuilt rather than altered, since DROP COLUMN needs SQLite 3.35.
+        """
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(streamers)")]
+        if not "login_lower" in columns:
+            return
+        self.db.executescript("""
+BEGIN;
+DROP INDEX IF EXISTS streamers_by_login;
+CREATE TABLE streamers_new (
+    guild_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    login TEXT NOT NULL,
+    PRIMARY KEY (guild_id, position)
+);
+INSERT INTO streamers_new (guild_id, position, login) SELECT guild_id, position, login FROM streamers;
+DROP TABLE streamers;
+ALTER TABLE streamers_new RENAME TO streamers;
+COMMIT;
+""")
+
+    def load(self) -> dict | None:
+        with self.lock:
+            meta = dict(self.db.execute("SELECT key, value FROM meta"))
+            if not "guild_template" in meta:
+                return None
+            data: dict = {k: json.loads(v) for k, v in meta.items()}
+            guilds: dict[str, dict] = {}
+            for guild_id, name, channel_id, streamer_role_id, live_role_id, extra in self.db.execute("SELECT guild_id, name, channel_id, streamer_role_id, live_role_id, extra FROM guilds"):
+                d = json.loads(extra)
+                d.update({
+                    "name": name,
+                    "channel_id": channel_id,
+                    "streamer_role_id": streamer_role_id,
+                    "live_role_id": live_role_id,
+                    "twitch_streamer_list": [],
+                    "twitch_category_list": [],
+                    "streamer_roles": {},
+                    "muted_role_list": [],
+                })
+                guilds[guild_id] = d
+            for guild_id, login in self.db.execute("SELECT guild_id, login FROM streamers ORDER BY guild_id, position"):
+                guilds[guild_id]["twitch_streamer_list"].append(login)
+            for guild_id, name in self.db.execute("SELECT guild_id, name FROM categories ORDER BY guild_id, position"):
+                guilds[guild_id]["twitch_category_list"].append(name)
+            for guild_id, role_id, filtered in self.db.execute("SELECT guild_id, role_id, filtered FROM streamer_roles"):
+                guilds[guild_id]["streamer_roles"][str(role_id)] = bool(filtered)
+            for guild_id, role_id in self.db.execute("SELECT guild_id, role_id FROM muted_roles ORDER BY guild_id, role_id"):
+                guilds[guild_id]["muted_role_list"].append(role_id)
+            data["guilds"] = guilds
+            return data
+
+    def snapshot(self, data: dict, guild_ids: set[str] | None) -> dict:
+        """
+        Copies only what needs writing: everything but the guilds,
+        and the guilds in guild_ids, or all of them if it's None.
+        A guild that's been removed from data is copied as None.
+        """
+        guilds = data["guilds"]
+        if guild_ids is None:
+            guild_ids = set(guilds.keys())
+        snapshot = {k: copy.deepcopy(v) for k, v in data.items() if k != "guilds"}
+        snapshot["guilds"] = {g: copy.deepcopy(guilds.get(g)) for g in guild_ids}
+        return snapshot
+
+    def write(self, snapshot: dict):
+        with self.lock, self.db:
+            for k, v in snapshot.items():
+                if k != "guilds":
+                    self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (k, json.dumps(v)))
+            for guild_id, d in snapshot["guilds"].items():
+                for table in CHILD_TABLES:
+                    self.db.execute("DELETE FROM " + table + " WHERE guild_id = ?", (guild_id,))
+                if d is None:
+                    self.db.execute("DELETE FROM guilds WHERE guild_id = ?", (guild_id,))
+                    continue
+                self.write_guild(guild_id, d)
+
+    def write_guild(self, guild_id: str, d: dict):
+        extra = {k: v for k, v in d.items() if not (k in GUILD_COLUMNS or k in GUILD_TABLES)}
+        self.db.execute(
+            "INSERT OR REPLACE INTO guilds (guild_id, name, channel_id, streamer_role_id, live_role_id, extra) VALUES (?, ?, ?, ?, ?, ?)",
+            (guild_id, d.get("name", ""), d.get("channel_id") or 0, d.get("streamer_role_id") or 0, d.get("live_role_id") or 0, json.dumps(extra)),
+        )
+        self.db.executemany(
+            "INSERT INTO streamers (guild_id, position, login) VALUES (?, ?, ?)",
+            ((guild_id, i, login) for i, login in enumerate(d.get("twitch_streamer_list", []))),
+        )
+        self.db.executemany(
+            "INSERT INTO categories (guild_id, position, name) VALUES (?, ?, ?)",
+            ((guild_id, i, name) for i, name in enumerate(d.get("twitch_category_list", []))),
+        )
+        if "streamer_roles" in d:
+            streamer_roles = d["streamer_roles"]
+        else:
+            streamer_roles = { str(d["streamer_role_id"]): False } if ("streamer_role_id" in d and d["streamer_role_id"]) else {}
+        self.db.executemany(
+            "INSERT OR REPLACE INTO streamer_roles (guild_id, role_id, filtered) VALUES (?, ?, ?)",
+            ((guild_id, int(role_id), 1 if filtered else 0) for role_id, filtered in streamer_roles.items()),
+        )
+        self.db.executemany(
+            "INSERT OR REPLACE INTO muted_roles (guild_id, role_id) VALUES (?, ?)",
+            ((guild_id, role_id) for role_id in d.get("muted_role_list", [])),
+        )
+
+def import_json(json_path: str, sqlite_path: str):
+    data = JsonStorage(json_path).load()
+    if data is None:
+        raise FileNotFoundError(json_path)
+    target = SqliteStorage(sqlite_path)
+    target.write(target.snapshot(data, None))
+    print("Imported " + str(len(data["guilds"])) + " guilds from " + json_path + " into " + sqlite_path, flush=True)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "import":
+        print("Usage: python src/storage.py import [save.json] [save.db]")
+        sys.exit(1)
+    import_json(sys.argv[2] if 2 < len(sys.argv) else "save.json", sys.argv[3] if 3 < len(sys.argv) else "save.db")
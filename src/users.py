@@ -0,0 +1,123 @@
+"""
+Resolves the Twitch logins that guilds watch to user ids, which is what Twitch is polled by,
+so that mistyped logins and deleted accounts aren't polled, and renamed accounts keep being found.
+
+Watched logins without a user id are resolved in bulk before each poll,
+and the ids are kept in each guild's twitch_user_ids.
+Each id is checked again every twitch_id_refresh_hours, spread out over that time,
+which follows renames, and drops the ids of accounts that are gone.
+Logins that Twitch doesn't find are reported once, and tried again with backoff.
+"""
+import time, traceback, zlib
+
+import config
+import helix
+import imagecache
+import save
+from twitchAPI.object.api import TwitchUser
+from twitchAPI.twitch import Twitch
+
+REFRESH = config.twitch_id_refresh_hours * 60 * 60
+# How many logins that Twitch didn't find to remember, separate from the image caches
+MISS_CAPACITY = 10000
+
+# casefolded login -> when its user id was last checked
+checked_at: dict[str, float] = {}
+# Logins that Twitch didn't find
+misses = imagecache.MissCache(MISS_CAPACITY, REFRESH)
+
+def canonical_name(user: TwitchUser) -> str:
+    """
+    The user's display name, if it only differs from the login by case, which not every display name does.
+    """
+    return user.display_name if user.display_name.casefold() == user.login.casefold() else user.login
+
+def is_invalid(lower_name: str) -> bool:
+    return lower_name in misses and not lower_name in save.user_ids
+
+def report_invalid(lower_name: str):
+    if not lower_name in misses:
+        for g, cap_name in save.get_streamer_guilds(lower_name).items():
+            print("Twitch user not found: " + cap_name + ", in server name: " + save.get_guild_data(g)["name"], flush=True)
+    misses.missed(lower_name)
+
+def found(user: TwitchUser):
+    lower_name = user.login.casefold()
+    misses.found(lower_name)
+    checked_at[lower_name] = time.time()
+    save.set_user_id(lower_name, user.id, canonical_name(user))
+
+async def lookup(api: Twitch, lower_name: str) -> TwitchUser | None:
+    """
+    Resolves one login right away, such as when it's added with a command.
+    """
+    for user in await helix.get_users(api, (lower_name,)):
+        if user.login.casefold() == lower_name:
+            return user
+    return None
+
+async def resolve_new(api: Twitch) -> bool:
+    """
+    Resolves the watched logins that don't have a user id yet.
+    Returns whether any were resolved.
+    """
+    unknowns = [n for n in save.get_lower_set_all() if not n in save.user_ids and misses.should_try(n)]
+    if not unknowns:
+        return False
+    resolved = False
+    for batch, users in await helix.gather_batches(helix.get_users, api, unknowns):
+        if isinstance(users, BaseException):
+            print("Twitch API Error resolving user ids", flush=True)
+            traceback.print_exception(users)
+            continue
+        for user in users:
+            found(user)
+            resolved = True
+        for lower_name in batch:
+            if not lower_name in save.user_ids:
+                report_invalid(lower_name)
+    return resolved
+
+async def refresh_stale(api: Twitch) -> bool:
+    """
+    Checks the user ids that were last checked more than twitch_id_refresh_hours ago.
+    Returns whether any streamer was renamed or is gone.
+    """
+    now = time.time()
+    # user id -> casefolded login
+    stale: dict[str, str] = {}
+    for lower_name in save.get_lower_set_all():
+        user_id = save.user_ids.get(lower_name)
+        if not user_id:
+            continue
+        if not lower_name in checked_at:
+            # After a restart, spread the checks out over the refresh period instead of doing them all now
+            checked_at[lower_name] = now - zlib.crc32(lower_name.encode()) % max(1, int(REFRESH))
+        if REFRESH <= now - checked_at[lower_name]:
+            stale[user_id] = lower_name
+    if not stale:
+        return False
+    changed = False
+    for batch, users in await helix.gather_batches(helix.get_users_by_id, api, stale.keys()):
+        if isinstance(users, BaseException):
+            print("Twitch API Error checking user ids", flush=True)
+            traceback.print_exception(users)
+            continue
+        found_ids: set[str] = set()
+        for user in users:
+            found_ids.add(user.id)
+            lower_name = stale[user.id]
+            if user.login.casefold() != lower_name:
+                print("Twitch user " + lower_name + " was renamed to " + user.login, flush=True)
+                checked_at.pop(lower_name, None)
+                save.rename_streamer(lower_name, canonical_name(user), user.id)
+                changed = True
+            found(user)
+        for user_id in batch:
+            if not user_id in found_ids:
+                lower_name = stale[user_id]
+                checked_at.pop(lower_name, None)
+                save.set_user_id(lower_name, None)
+                report_invalid(lower_name)
+                changed = True
+    return changed
@@ -0,0 +1,174 @@
+import asyncio, heapq, itertools, traceback
+from typing import Any, Awaitable, Callable, Hashable
+
+import config
+
+# Priorities, lower goes first
+POST = 0     # new "is live" messages, and live roles being added
+EDIT = 1     # edits to messages that are already posted
+CLEANUP = 2  # deleting messages, and live roles being removed
+
+class Write:
+    __slots__ = ("priority", "route", "key", "make", "on_error", "future")
+
+    def __init__(self, priority: int, route: Hashable, key: Hashable | None, make: Callable[[], Awaitable[Any]], on_error: Callable[[BaseException], None] | None, future: asyncio.Future):
+        self.priority = priority
+        self.route = route
+        self.key = key
+        self.make = make
+        self.on_error = on_error
+        self.future = future
+
+async def skip():
+    return None
+
+def report_error(e: BaseException):
+    print("Error in Discord write", flush=True)
+    traceback.print_exception(e)
+
+class WriteScheduler:
+    """
+    Queues Discord writes, and sends them from a fixed number of workers.
+
+    Writes are grouped into routes, matching Discord's rate limit buckets,
+    such as one route per channel for messages and one per guild for roles.
+    A route has at most one write in flight, so its writes happen in order
+    of priority and then submission, and a route that's being rate limited
+    only holds up its own writes.
+
+    Writes submitted with the same key while one is still queued
+    are coalesced, so only the latest version is sent.
+    """
+
+    def __init__(self, concurrency: int, slots: asyncio.Semaphore | None = None):
+        self.concurrency = max(1, concurrency)
+        # Shared with other requests, if given, so together they stay under one limit
+        self.slots = slots
+        self.seq = itertools.count()
+        # Queued writes for each route, as heaps of (priority, seq, write)
+        self.routes: dict[Hashable, list[tuple[int, int, Write]]] = {}
+        # Routes that have queued writes and nothing in flight, as a heap of (priority, seq, route).
+        # Entries can be stale, they're checked again when popped.
+        self.ready: list[tuple[int, int, Hashable]] = []
+        self.busy: set[Hashable] = set()
+        self.queued_keys: dict[Hashable, Write] = {}
+        self.in_flight = 0
+        self.workers: list[asyncio.Task] = []
+        self.wakeup: asyncio.Event | None = None
+        self.idle: asyncio.Event | None = None
+
+    def start(self):
+        if self.wakeup is not None:
+            return
+        self.wakeup = asyncio.Event()
+        self.idle = asyncio.Event()
+        self.workers = [asyncio.create_task(self.work()) for _ in range(self.concurrency)]
+
+    def submit(self, priority: int, route: Hashable, make: Callable[[], Awaitable[Any]], *, key: Hashable | None = None, on_error: Callable[[BaseException], None] | None = None) -> asyncio.Future:
+        """
+        Queues make() to be called and awaited by a worker.
+        Returns a future for its result, which is None if it failed.
+        Failures are passed to on_error instead of being raised.
+        """
+        self.start()
+        assert self.wakeup is not None
+        if key is not None and key in self.queued_keys:
+            w = self.queued_keys[key]
+            w.make = make
+            w.on_error = on_error
+            return w.future
+        w = Write(priority, route, key, make, on_error, asyncio.get_running_loop().create_future())
+        seq = next(self.seq)
+        if not route in self.routes:
+            self.routes[route] = []
+        heapq.heappush(self.routes[route], (priority, seq, w))
+        if key is not None:
+            self.queued_keys[key] = w
+        if not route in self.busy:
+            heapq.heappush(self.ready, (priority, seq, route))
+            self.wakeup.set()
+        return w.future
+
+    def is_queued(self, key: Hashable) -> bool:
+        return key in self.queued_keys
+
+    def cancel(self, key: Hashable):
+        """
+        Drops the queued write with this key, if it hasn't started yet.
+        """
+        w = self.queued_keys.get(key)
+        if w is not None:
+            w.make = skip
+
+    def pop_ready(self) -> Write | None:
+        while self.ready:
+            _, _, route = heapq.heappop(self.ready)
+            if route in self.busy or not self.routes.get(route):
+                continue
+            _, _, w = heapq.heappop(self.routes[route])
+            if not self.routes[route]:
+                self.routes.pop(route, None)
+            if w.key is not None:
+                self.queued_keys.pop(w.key, None)
+            self.busy.add(route)
+            self.in_flight += 1
+            return w
+        return None
+
+    def finish(self, w: Write):
+        self.in_flight -= 1
+        self.busy.discard(w.route)
+        queue = self.routes.get(w.route)
+        if queue:
+            priority, seq, _ = queue[0]
+            heapq.heappush(self.ready, (priority, seq, w.route))
+        if self.wakeup is not None:
+            self.wakeup.set()
+        if self.idle is not None and not self.routes and self.in_flight == 0:
+            self.idle.set()
+
+    async def work(self):
+        assert self.wakeup is not None
+        wakeup = self.wakeup
+        while True:
+            w = self.pop_ready()
+            if w is None:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            try:
+                if self.slots is None:
+                    result = await w.make()
+                else:
+                    async with self.slots:
+                        result = await w.make()
+                if not w.future.done():
+                    w.future.set_result(result)
+            except Exception as e:
+                (w.on_error or report_error)(e)
+                if not w.future.done():
+                    w.future.set_result(None)
+            finally:
+                self.finish(w)
+
+    async def drain(self):
+        """
+        Waits for every queued write to be sent, then stops the workers.
+        """
+        idle = self.idle
+        if idle is None:
+            return
+        while self.routes or self.in_flight:
+            idle.clear()
+            await idle.wait()
+        for t in self.workers:
+            t.cancel()
+        self.workers = []
+        self.wakeup = None
+        self.idle = None
+
+# Limits how many Discord API requests are in flight at once,
+# taken by every write here and by the bot's reads, such as reading channel history
+slots = asyncio.Semaphore(max(1, config.discord_concurrency))
+
+scheduler = WriteScheduler(config.discord_concurrency, slots)